@@ -1,7 +1,7 @@
 from fastapi import APIRouter
 
-from .endpoints import images
+from .endpoints import images, metrics
 
 api_router = APIRouter()
-for router in [(images.router, "/images", ["images"])]:
+for router in [(images.router, "/images", ["images"]), (metrics.router, "/metrics", ["metrics"])]:
     api_router.include_router(router[0], prefix=router[1], tags=router[2])
@@ -16,6 +16,18 @@ async def get_db_session() -> AsyncSession:
             yield session
 
 
+async def release_db_session(session: AsyncSession) -> None:
+    """
+    Commit request transaction, so its connection is returned to pool before response body is sent.
+    Teardown of get_db_session runs only after the whole body is streamed to client.
+    Loaded objects are not expired on commit, but the session must not be used after release: transaction of
+    get_db_session is closed and any query raises InvalidRequestError until its context manager exits.
+    Release can be called more than once, rollback after release does nothing
+    """
+    if session.in_transaction():
+        await session.commit()
+
+
 async def get_image_crud(
         session: AsyncSession = Depends(get_db_session)
 ) -> AsyncGenerator[AsyncSession, None]: yield ImageCRUD(session)
@@ -1,19 +1,25 @@
+import asyncio
 import os.path
-import tempfile
 import traceback
-import uuid
-from typing import Optional
+from dataclasses import asdict
+from typing import List, Optional
 
-from fastapi import APIRouter, Depends, UploadFile
+from fastapi import (APIRouter, BackgroundTasks, Depends, Header, Query,
+                     Request, UploadFile)
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import FileResponse
+from fastapi.responses import Response
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app import models, schemas
 from app.api import deps
-from app.core import (error, hasher, image_comparator, image_resizer, message,
-                      util)
+from app.core import (delivery, error, hasher, http_cache, image_comparator,
+                      image_resizer, message, renditions, staging, util)
 from app.core.config import settings
+from app.core.executor import cpu_executor
+from app.core.file_response import RangeFileResponse
 from app.crud import ImageCRUD, ThumbnailCRUD
+from app.services.comparison import comparison_service
+from app.services.thumbnail import thumbnail_service
 
 router = APIRouter()
 
@@ -23,11 +29,20 @@ async def get_all_images(
         pagination_data: schemas.PaginationData = Depends(),
         image_crud: ImageCRUD = Depends(deps.get_image_crud),
 ) -> schemas.PaginatedResponse:
-    data = await image_crud.get_all_with_pagination(
-        wrapper_class=schemas.Image,
-        offset=pagination_data.offset,
-        limit=pagination_data.limit,
-    )
+    if pagination_data.is_cursor_mode:
+        data = await image_crud.get_all_with_cursor_pagination(
+            wrapper_class=schemas.Image,
+            cursor=pagination_data.cursor,
+            limit=pagination_data.limit,
+            count=pagination_data.count,
+        )
+    else:
+        data = await image_crud.get_all_with_pagination(
+            wrapper_class=schemas.Image,
+            offset=pagination_data.offset,
+            limit=pagination_data.limit,
+            count=pagination_data.count,
+        )
     return await schemas.paginate_response(data, pagination_data)
 
 
@@ -38,67 +53,141 @@ async def get_image(
     return schemas.Image(**jsonable_encoder(image))
 
 
+def get_file_headers(file_type: str, requested_format: Optional[schemas.RenditionFormats]) -> dict:
+    headers = {'Content-Type': f'image/{file_type}'}
+    if requested_format is None and settings.RENDITION_FORMATS:
+        # the same url is served in different formats by Accept header
+        headers['Vary'] = 'Accept'
+    return headers
+
+
+def is_content_addressed(request: Request) -> bool:
+    # image can be requested by name too, but only its id always points to the same content
+    return schemas.is_valid_uuid(request.path_params['image_id'])
+
+
+def get_not_modified_response(headers: dict) -> Response:
+    return Response(status_code=304, headers={k: v for k, v in headers.items() if k != 'Content-Type'})
+
+
+def get_file_response(path: str, headers: dict) -> Response:
+    if delivery.is_offloaded():
+        # body is sent by front proxy, it handles ranges of the file itself
+        return Response(headers={**headers, **delivery.get_redirect_headers(path)})
+    return RangeFileResponse(path=path, headers=headers, chunk_size=settings.FILE_CHUNK_SIZE)
+
+
 @router.get('/{image_id}/file')
 async def get_image_file(
+        request: Request,
         scale: float = None,
         w: int = None,
         h: int = None,
+        format: Optional[schemas.RenditionFormats] = None,
+        quality: Optional[int] = Query(None, ge=1, le=100),
+        accept: Optional[str] = Header(None),
+        if_none_match: Optional[str] = Header(None),
         image: models.Image = Depends(deps.get_path_image),
         image_crud: ThumbnailCRUD = Depends(deps.get_image_crud),
         thumbnail_crud: ThumbnailCRUD = Depends(deps.get_thumbnail_crud)
-) -> FileResponse:
+) -> Response:
     try:
         path = util.get_image_path(image=image)
+        file_type, quality = renditions.get_rendition(image.file_type, accept, format, quality)
+        if scale:
+            (w, h) = image_resizer.get_scaled_size(path, scale, original_size=image.dimensions)
+        if w or h:
+            (w, h) = image_resizer.get_new_size(path, w, h, original_size=image.dimensions)
+        elif file_type != image.file_type or quality:
+            # full size rendition in other format or quality
+            (w, h) = image.dimensions or image_resizer.get_size(path)
+        etag = http_cache.get_etag(http_cache.get_file_tag(image), (w, h) if w or h else None, file_type, quality)
+        headers = {
+            **get_file_headers(file_type, format),
+            **http_cache.get_cache_headers(etag, immutable=is_content_addressed(request)),
+        }
+        # sizes are computed from stored dimensions, so revalidation does not touch files
+        if http_cache.is_not_modified(if_none_match, etag):
+            return get_not_modified_response(headers)
         if not os.path.exists(path):
-            await image_crud.delete_with_content(image.id)
             await thumbnail_crud.delete_by_with_content(image_id=image.id)
-        if scale:
-            (w, h) = image_resizer.get_scaled_size(path, scale)
+            await image_crud.delete_with_content(image.id)
         if w or h:
-            (w, h) = image_resizer.get_new_size(path, w, h)
-            if not await thumbnail_crud.has_by(image_id=image.id, width=w, height=h):
-                thumbnail = await thumbnail_crud.create(image=image, width=w, height=h, file_type=image.file_type)
-                image_resizer.resize_image(path, util.get_thumbnail_path(thumbnail), (w, h))
-            else:
-                thumbnail = await thumbnail_crud.get_by(image_id=image.id, width=w, height=h)
+            thumbnail = await thumbnail_service.get_cached(image, w, h, file_type, thumbnail_crud, quality)
+            # generation uses its own session, so connection is not held while thumbnail is generated
+            await deps.release_db_session(image_crud.db_session)
+            if thumbnail is None:
+                thumbnail = await thumbnail_service.get_or_create(
+                    image, width=w, height=h, file_type=file_type, quality=quality
+                )
             path = util.get_thumbnail_path(thumbnail)
-        return FileResponse(
-            path=path,
-            headers={
-                'Content-Type': f'image/{image.file_type}'
-            }
-        )
+        await deps.release_db_session(image_crud.db_session)
+        return get_file_response(path, headers)
     except Exception as e:
         await image_crud.db_session.rollback()
         traceback.print_exc()
         raise e
 
 
+@router.get('/{image_id}/similar', response_model=List[schemas.SimilarImage])
+async def get_similar_images(
+        max_distance: int = Query(settings.PHASH_NEAR_DEDUP_DISTANCE, ge=0, le=64),
+        limit: int = Query(10, ge=1),
+        image: models.Image = Depends(deps.get_path_image),
+        image_crud: ImageCRUD = Depends(deps.get_image_crud),
+) -> List[schemas.SimilarImage]:
+    return [
+        schemas.SimilarImage(image=schemas.Image(**jsonable_encoder(item)), distance=distance)
+        for distance, item in await image_crud.get_similar(
+            image.phash, max_distance=max_distance, limit=limit, exclude_id=image.id
+        )
+    ]
+
+
 @router.post('/', response_model=schemas.Image)
 async def create_image(
         file: UploadFile,
+        background_tasks: BackgroundTasks,
         name: Optional[str] = None,
+        near_dedup: bool = False,
+        max_distance: int = Query(settings.PHASH_NEAR_DEDUP_DISTANCE, ge=0, le=64),
         image_crud: ImageCRUD = Depends(deps.get_image_crud),
 ) -> schemas.Image:
+    staged_file = await staging.stage_upload(file)
     try:
-        file_data = file.file.read()
-        hash_value = hasher.get_image_hash(file_data)
-        if await image_crud.has_by(hash=hash_value):
-            image = await image_crud.get_by(hash=hash_value)
-            print(f'{image=}')
-            await image_crud.increment_counter(image_id=image.id)
+        # same file bytes were already uploaded, so pixels decoding can be skipped
+        if image := await image_crud.get_by_file_digest(staged_file.digest):
+            image = await image_crud.increment_counter(image_id=image.id)
             return schemas.Image(**jsonable_encoder(image))
-        image = await image_crud.create_and_write(
+        (hashes, phash), info = await asyncio.gather(
+            cpu_executor.run(hasher.get_image_file_hashes, staged_file.path, settings.hash_algorithms),
+            cpu_executor.run(image_resizer.get_image_info, staged_file.path),
+        )
+        hash_value = hashes.pop(settings.HASH_ALGORITHM)
+        if near_dedup and not await image_crud.get_by_any_hash([hash_value, *hashes.values()]):
+            if similar := await image_crud.get_similar(phash, max_distance=max_distance, limit=1):
+                image = await image_crud.increment_counter(image_id=similar[0][1].id)
+                return schemas.Image(**jsonable_encoder(image))
+        image, created = await image_crud.create_and_write(
             original_filename=file.filename,
             hash_value=hash_value,
-            file_data=file_data,
+            staged_file=staged_file,
+            phash=phash,
             name=name,
+            legacy_hashes=list(hashes.values()),
+            info=info,
         )
+        if created:
+            # presets pipeline uses its own session, so image row need to be visible for it
+            await image_crud.db_session.commit()
+            background_tasks.add_task(thumbnail_service.generate_presets, image)
         return schemas.Image(**jsonable_encoder(image))
     except Exception as e:
         await image_crud.db_session.rollback()
         traceback.print_exc()
         raise e
+    finally:
+        staged_file.discard()
 
 
 @router.put('/{image_id}', response_model=schemas.Image)
@@ -116,7 +205,7 @@ async def delete_image(
         thumbnail_crud: ImageCRUD = Depends(deps.get_thumbnail_crud),
         image_crud: ImageCRUD = Depends(deps.get_image_crud),
 ) -> None:
-    await image_crud.decrement_counter(image_id=image.id)
+    image = await image_crud.decrement_counter(image_id=image.id)
     if image.duplicate_counter <= 0:
         await thumbnail_crud.delete_by_with_content(image_id=image.id)
         await image_crud.delete_with_content(image.id)
@@ -128,12 +217,24 @@ async def get_image_thumbnails(
         image: models.Image = Depends(deps.get_path_image),
         thumbnail_crud: ImageCRUD = Depends(deps.get_thumbnail_crud),
 ) -> schemas.PaginatedResponse:
-    data = await thumbnail_crud.get_all_with_pagination(
-        wrapper_class=schemas.Thumbnail,
-        offset=pagination_data.offset,
-        limit=pagination_data.limit,
-        image_id=image.id,
-    )
+    # renditions in other format or quality are stored as thumbnails too, but are not listed
+    filters = dict(image_id=image.id, file_type=image.file_type, quality=0)
+    if pagination_data.is_cursor_mode:
+        data = await thumbnail_crud.get_all_with_cursor_pagination(
+            wrapper_class=schemas.Thumbnail,
+            cursor=pagination_data.cursor,
+            limit=pagination_data.limit,
+            count=pagination_data.count,
+            **filters,
+        )
+    else:
+        data = await thumbnail_crud.get_all_with_pagination(
+            wrapper_class=schemas.Thumbnail,
+            offset=pagination_data.offset,
+            limit=pagination_data.limit,
+            count=pagination_data.count,
+            **filters,
+        )
     return await schemas.paginate_response(data, pagination_data)
 
 
@@ -146,15 +247,42 @@ async def get_thumbnail(
 
 @router.get('/{image_id}/thumbnails/{thumbnail_id}/file')
 async def get_thumbnail_file(
+        request: Request,
+        format: Optional[schemas.RenditionFormats] = None,
+        quality: Optional[int] = Query(None, ge=1, le=100),
+        accept: Optional[str] = Header(None),
+        if_none_match: Optional[str] = Header(None),
+        image: models.Image = Depends(deps.get_path_image),
         thumbnail: models.Thumbnail = Depends(deps.get_path_thumbnail),
-) -> FileResponse:
-    path = util.get_thumbnail_path(thumbnail)
-    return FileResponse(
-        path=path,
-        headers={
-            'Content-Type': f'image/{thumbnail.file_type}'
-        }
-    )
+        thumbnail_crud: ThumbnailCRUD = Depends(deps.get_thumbnail_crud),
+) -> Response:
+    file_type, quality = renditions.get_rendition(thumbnail.file_type, accept, format, quality)
+    if (file_type, quality) == (thumbnail.file_type, 0):
+        quality = thumbnail.quality
+    etag = http_cache.get_etag(http_cache.get_file_tag(image), (thumbnail.width, thumbnail.height), file_type, quality)
+    headers = {
+        **get_file_headers(file_type, format),
+        **http_cache.get_cache_headers(etag, immutable=is_content_addressed(request)),
+    }
+    if http_cache.is_not_modified(if_none_match, etag):
+        return get_not_modified_response(headers)
+    if (file_type, quality) == (thumbnail.file_type, thumbnail.quality) and (
+            os.path.exists(util.get_thumbnail_path(thumbnail))
+    ):
+        thumbnail_service.track_access(thumbnail)
+        cached = thumbnail
+    else:
+        # rendition is requested or file could be removed by cache eviction after row was read
+        cached = await thumbnail_service.get_cached(
+            image, thumbnail.width, thumbnail.height, file_type, thumbnail_crud, quality
+        )
+    # generation uses its own session, so connection is not held while file is generated and sent
+    await deps.release_db_session(thumbnail_crud.db_session)
+    if cached is None:
+        cached = await thumbnail_service.get_or_create(
+            image, width=thumbnail.width, height=thumbnail.height, file_type=file_type, quality=quality
+        )
+    return get_file_response(util.get_thumbnail_path(cached), headers)
 
 
 @router.post('/{image_id}/thumbnails', response_model=schemas.Thumbnail)
@@ -165,15 +293,51 @@ async def create_image_thumbnail(
 ) -> schemas.Thumbnail:
     path = util.get_image_path(image=image)
     if item_in.scale:
-        (item_in.width, item_in.height) = image_resizer.get_scaled_size(path, item_in.scale)
-    (w, h) = image_resizer.get_new_size(path, item_in.width, item_in.height)
-    if await thumbnail_crud.has_by(image_id=image.id, width=w, height=h):
+        (item_in.width, item_in.height) = image_resizer.get_scaled_size(
+            path, item_in.scale, original_size=image.dimensions
+        )
+    (w, h) = image_resizer.get_new_size(path, item_in.width, item_in.height, original_size=image.dimensions)
+    if await thumbnail_crud.has_by(image_id=image.id, width=w, height=h, file_type=image.file_type, quality=0):
         raise error.ItemAlreadyExists(model=message.MODEL_THUMBNAIL)
-    thumbnail = await thumbnail_crud.create(image=image, width=w, height=h, file_type=image.file_type)
-    image_resizer.resize_image(path, util.get_thumbnail_path(thumbnail), (w, h))
+    thumbnail = await thumbnail_service.get_or_create(image, width=w, height=h, file_type=image.file_type)
     return schemas.Thumbnail(**jsonable_encoder(thumbnail))
 
 
+def get_batch_sizes(image: models.Image, item_in: schemas.ThumbnailBatchCreate) -> list[tuple[int, int]]:
+    return image_resizer.get_new_sizes(
+        util.get_image_path(image=image),
+        [(size.scale, size.width, size.height) for size in item_in.sizes],
+        original_size=image.dimensions,
+    )
+
+
+@router.post('/thumbnails/batch', response_model=List[schemas.Thumbnail])
+async def create_images_thumbnails(
+        item_in: schemas.ImagesThumbnailBatchCreate,
+        image_crud: ImageCRUD = Depends(deps.get_image_crud),
+        thumbnail_crud: ThumbnailCRUD = Depends(deps.get_thumbnail_crud),
+) -> List[schemas.Thumbnail]:
+    images = await image_crud.get_all(id=item_in.image_ids)
+    if len(images) != len(set(item_in.image_ids)):
+        raise error.ItemNotFound(model=message.MODEL_IMAGE)
+    thumbnails = await thumbnail_service.generate_many(
+        [(image, get_batch_sizes(image, item_in)) for image in images], thumbnail_crud=thumbnail_crud
+    )
+    return [schemas.Thumbnail(**jsonable_encoder(thumbnail)) for thumbnail in thumbnails]
+
+
+@router.post('/{image_id}/thumbnails/batch', response_model=List[schemas.Thumbnail])
+async def create_image_thumbnails(
+        item_in: schemas.ThumbnailBatchCreate,
+        image: models.Image = Depends(deps.get_path_image),
+        thumbnail_crud: ThumbnailCRUD = Depends(deps.get_thumbnail_crud),
+) -> List[schemas.Thumbnail]:
+    thumbnails = await thumbnail_service.generate_many(
+        [(image, get_batch_sizes(image, item_in))], thumbnail_crud=thumbnail_crud
+    )
+    return [schemas.Thumbnail(**jsonable_encoder(thumbnail)) for thumbnail in thumbnails]
+
+
 @router.delete('/{image_id}/thumbnails/{thumbnail_id}')
 async def delete_thumbnail(
         thumbnail_crud: ThumbnailCRUD = Depends(deps.get_thumbnail_crud),
@@ -182,31 +346,80 @@ async def delete_thumbnail(
     await thumbnail_crud.delete_with_content(thumbnail.id)
 
 
+@router.post('/compare', response_model=List[schemas.ImagePairCompare])
+async def compare_many_images(
+        item_in: schemas.ImageBatchCompare,
+        image_crud: ImageCRUD = Depends(deps.get_image_crud),
+) -> List[schemas.ImagePairCompare]:
+    image_ids = list(dict.fromkeys(item_in.image_ids))
+    requested_ids = {*image_ids, item_in.reference_id} - {None}
+    images = {it.id: it for it in await image_crud.get_all(id=list(requested_ids))}
+    if len(images) != len(requested_ids):
+        raise error.ItemNotFound(model=message.MODEL_IMAGE)
+    if item_in.reference_id:
+        pairs = [(images[item_in.reference_id], images[image_id]) for image_id in image_ids]
+    else:
+        pairs = [(images[it], images[it2]) for n, it in enumerate(image_ids) for it2 in image_ids[n + 1:]]
+    results = await comparison_service.compare_many(
+        pairs, tolerance=item_in.tolerance, with_metrics=item_in.metrics, max_side=item_in.max_side
+    )
+    return [
+        schemas.ImagePairCompare(
+            image_id=image.id,
+            image2_id=image2.id,
+            equal=equal,
+            metrics=schemas.ImageCompareMetrics(**asdict(metrics)) if metrics else None,
+        )
+        for (image, image2), (equal, metrics) in zip(pairs, results)
+    ]
+
+
 @router.get('/{image_id}/compare/{image2_id}', response_model=schemas.ImageCompareStatus)
 async def compare_images(
+        tolerance: int = Query(0, ge=0, le=255),
         image: models.Image = Depends(deps.get_path_image),
         image2: models.Image = Depends(deps.get_path_image_2),
 ) -> schemas.ImageCompareStatus:
-    return schemas.ImageCompareStatus(equal=image_comparator.are_images_equal(
-        util.get_image_path(image),
-        util.get_image_path(image2),
-    ))
+    return schemas.ImageCompareStatus(equal=await comparison_service.are_equal(image, image2, tolerance))
+
+
+@router.get('/{image_id}/compare/{image2_id}/metrics', response_model=schemas.ImageCompareMetrics)
+async def get_compare_metrics(
+        max_side: Optional[int] = Query(None, ge=8, le=10000),
+        image: models.Image = Depends(deps.get_path_image),
+        image2: models.Image = Depends(deps.get_path_image_2),
+        thumbnail_crud: ThumbnailCRUD = Depends(deps.get_thumbnail_crud),
+) -> schemas.ImageCompareMetrics:
+    metrics = await comparison_service.get_metrics(image, image2, max_side=max_side, thumbnail_crud=thumbnail_crud)
+    return schemas.ImageCompareMetrics(**asdict(metrics))
+
+
+def get_diff_headers(stats: image_comparator.DiffStats) -> dict:
+    return {
+        'X-Diff-Changed-Pixels': str(stats.changed_pixels),
+        'X-Diff-Total-Pixels': str(stats.total_pixels),
+        'X-Diff-Max-Delta': str(stats.max_delta),
+        'X-Diff-Bbox': ','.join(map(str, stats.bbox)) if stats.bbox else '',
+    }
 
 
 @router.get('/{image_id}/compare/{image2_id}/file')
 async def create_image_thumbnail(
+        tolerance: int = Query(0, ge=0, le=255),
         image: models.Image = Depends(deps.get_path_image),
         image2: models.Image = Depends(deps.get_path_image_2),
-) -> FileResponse:
-    out_path = os.path.join(settings.TEMP_DIR, str(uuid.uuid4()))
-    image_comparator.get_compare_image(
-        util.get_image_path(image),
-        util.get_image_path(image2),
-        out_path
-    )
-    return FileResponse(
-        path=out_path,
-        headers={
-            'Content-Type': f'image/jpg'
-        }
+        db_session: AsyncSession = Depends(deps.get_db_session),
+) -> Response:
+    # diff is computed from loaded rows only, so connection is not held while diff is computed and sent
+    await deps.release_db_session(db_session)
+    if delivery.is_offloaded():
+        path, data, stats = await comparison_service.get_diff_file(image, image2, tolerance)
+        if path:
+            return get_file_response(path, {'Content-Type': 'image/jpeg', **get_diff_headers(stats)})
+    else:
+        data, stats = await comparison_service.get_diff_image(image, image2, tolerance)
+    return Response(
+        content=data,
+        media_type='image/jpeg',
+        headers=get_diff_headers(stats),
     )
@@ -0,0 +1,10 @@
+from fastapi import APIRouter
+
+from app.core import metrics
+
+router = APIRouter()
+
+
+@router.get('/')
+async def get_metrics() -> dict:
+    return metrics.snapshot()
@@ -1,11 +1,12 @@
 import os.path
-import tempfile
 from pathlib import Path
 from typing import Literal, Union
 
 import toml
 from pydantic import AnyHttpUrl, AnyUrl, BaseSettings, validator
 
+from app.core import hash_algorithms
+
 PROJECT_DIR = os.path.abspath(Path(__file__).parent.parent.parent)
 PYPROJECT_CONTENT = toml.load(f'{PROJECT_DIR}/pyproject.toml')['tool']['poetry']
 
@@ -24,7 +25,55 @@ class Settings(BaseSettings):
 
     STORAGE_DIR: str = os.path.join(PROJECT_DIR, '.storage')
     THUMBNAILS_DIR: str = os.path.join(PROJECT_DIR, '.thumbnails')
-    TEMP_DIR: str = tempfile.mkdtemp(prefix="image-storage-compared-")
+    STAGING_DIR: str = ''
+    UPLOAD_CHUNK_SIZE: int = 1024 * 1024
+
+    CPU_EXECUTOR_TYPE: Literal["process", "thread"] = "process"
+    CPU_EXECUTOR_WORKERS: int = os.cpu_count() or 1
+    CPU_EXECUTOR_QUEUE_SIZE: int = 64
+
+    HASH_ALGORITHM: str = 'md5'
+    # algorithms of stored hashes that are not rehashed yet to HASH_ALGORITHM, uploads are checked against them too
+    HASH_LEGACY_ALGORITHMS: list[str] = []
+
+    # widths of thumbnails generated right after original upload
+    THUMBNAIL_PRESETS: list[int] = [64, 256, 1024]
+    # requested thumbnail sizes are rounded up to shared sizes, so near-identical sizes hit the same cache entry
+    THUMBNAIL_SIZE_SNAPPING: Literal["none", "buckets", "ladder"] = "none"
+    THUMBNAIL_SIZE_BUCKETS: list[int] = [64, 128, 256, 512, 1024, 2048]
+    THUMBNAIL_SIZE_LADDER_BASE: int = 16
+    THUMBNAIL_SIZE_LADDER_RATIO: float = 1.25
+    # formats served by Accept header negotiation in order of preference, e.g. ["avif", "webp"]
+    RENDITION_FORMATS: list[str] = []
+    RENDITION_QUALITY_TIERS: list[int] = [50, 75, 90]
+    RENDITION_DEFAULT_QUALITY: int = 75
+    # max-age of image and thumbnail files requested by image id, their content never changes
+    FILE_CACHE_MAX_AGE: int = 365 * 24 * 3600
+    # read size of files sent without zero-copy, bigger chunks give more throughput for large files
+    FILE_CHUNK_SIZE: int = 1024 * 1024
+    # files can be sent by front proxy from internal redirect header instead of app workers
+    FILE_DELIVERY: Literal["app", "x-accel-redirect", "x-sendfile"] = "app"
+    # nginx internal locations that are aliases of STORAGE_DIR and DIFF_CACHE_DIR for x-accel-redirect delivery
+    FILE_DELIVERY_STORAGE_LOCATION: str = '/protected/storage/'
+    FILE_DELIVERY_DIFF_CACHE_LOCATION: str = '/protected/diffs/'
+    THUMBNAILS_CACHE_MAX_BYTES: int = 10 * 1024 ** 3
+    THUMBNAILS_CACHE_POLICY: Literal["lru", "lfu"] = "lru"
+    THUMBNAILS_CACHE_EVICTION_INTERVAL: float = 60.0
+    THUMBNAILS_ACCESS_FLUSH_INTERVAL: float = 10.0
+
+    # amount of cached pixels comparison results per worker
+    COMPARE_CACHE_SIZE: int = 10000
+    # maximum size of decoded images of one batch comparison
+    COMPARE_BATCH_MAX_BYTES: int = 2 * 1024 ** 3
+    # diff images are not cached on disk if dir is not set
+    DIFF_CACHE_DIR: str = ''
+    DIFF_CACHE_MAX_BYTES: int = 1024 ** 3
+    DIFF_CACHE_EVICTION_INTERVAL: float = 60.0
+
+    PHASH_INDEX_SYNC_INTERVAL: float = 5.0
+    # rows per index load query and indexed ids checked for deletion per sync
+    PHASH_INDEX_BATCH_SIZE: int = 10000
+    PHASH_NEAR_DEDUP_DISTANCE: int = 4
 
     POSTGRES_SERVER: str
     POSTGRES_USER: str
@@ -52,5 +101,54 @@ class Settings(BaseSettings):
             os.makedirs(path)
         return path
 
+    @validator('DIFF_CACHE_DIR')
+    def _assemble_diff_cache(cls, v: str) -> str:  # noqa
+        if not v:
+            return v
+        path = os.path.abspath(v)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        return path
+
+    @validator('HASH_ALGORITHM')
+    def _validate_hash_algorithm(cls, v: str) -> str:  # noqa
+        return hash_algorithms.get_algorithm(v).name
+
+    @validator('HASH_LEGACY_ALGORITHMS', each_item=True)
+    def _validate_hash_legacy_algorithms(cls, v: str) -> str:  # noqa
+        return hash_algorithms.get_algorithm(v).name
+
+    @property
+    def hash_algorithms(self) -> tuple[str, ...]:
+        return (self.HASH_ALGORITHM, *(it for it in self.HASH_LEGACY_ALGORITHMS if it != self.HASH_ALGORITHM))
+
+    @validator('THUMBNAIL_SIZE_BUCKETS')
+    def _sort_thumbnail_size_buckets(cls, v: list[int]) -> list[int]:  # noqa
+        return sorted(set(v))
+
+    @validator('RENDITION_QUALITY_TIERS')
+    def _sort_rendition_quality_tiers(cls, v: list[int]) -> list[int]:  # noqa
+        return sorted(set(v))
+
+    @validator('THUMBNAIL_SIZE_LADDER_BASE')
+    def _validate_thumbnail_size_ladder_base(cls, v: int) -> int:  # noqa
+        if v < 1:
+            raise ValueError('thumbnail size ladder base need to be positive')
+        return v
+
+    @validator('THUMBNAIL_SIZE_LADDER_RATIO')
+    def _validate_thumbnail_size_ladder_ratio(cls, v: float) -> float:  # noqa
+        if v <= 1:
+            raise ValueError('thumbnail size ladder ratio need to be greater than 1')
+        return v
+
+    @validator('STAGING_DIR', always=True)
+    def _assemble_staging(cls, v: str, values: dict[str, str]) -> str:  # noqa
+        # staging dir has to be on the same filesystem as storage to move files with atomic rename
+        path = os.path.abspath(v or os.path.join(values.get('STORAGE_DIR'), '.staging'))
+        if not os.path.exists(path):
+            os.makedirs(path)
+        return path
+
 
 settings = Settings()
@@ -0,0 +1,33 @@
+"""
+Files delivery offload to a front proxy. App still does lookups and thumbnails generation, but the body is sent
+by proxy from internal redirect header: X-Accel-Redirect with internal location uri (nginx)
+or X-Sendfile with absolute file path (apache mod_xsendfile, lighttpd)
+"""
+import os
+from urllib.parse import quote
+
+from app.core.config import settings
+
+
+def is_offloaded() -> bool:
+    return settings.FILE_DELIVERY != 'app'
+
+
+def get_internal_uri(path: str) -> str:
+    """
+    Uri of file in proxy internal location of storage or diff cache dir
+    """
+    path = os.path.abspath(path)
+    for directory, location in (
+            (settings.STORAGE_DIR, settings.FILE_DELIVERY_STORAGE_LOCATION),
+            (settings.DIFF_CACHE_DIR, settings.FILE_DELIVERY_DIFF_CACHE_LOCATION),
+    ):
+        if directory and os.path.commonpath([directory, path]) == directory:
+            return location.rstrip('/') + '/' + quote(os.path.relpath(path, directory).replace(os.sep, '/'))
+    raise ValueError(f'file {path} is out of delivered dirs')
+
+
+def get_redirect_headers(path: str) -> dict:
+    if settings.FILE_DELIVERY == 'x-sendfile':
+        return {'X-Sendfile': os.path.abspath(path)}
+    return {'X-Accel-Redirect': get_internal_uri(path)}
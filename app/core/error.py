@@ -47,3 +47,8 @@ class StorageSaveError(Exception):
 class ResizingSizeError(Exception):
     def __str__(self) -> str:
         return message.ERROR_RESIZING_SIZE
+
+
+class ExecutorOverloaded(Exception):
+    def __str__(self) -> str:
+        return message.ERROR_EXECUTOR_OVERLOADED
@@ -0,0 +1,96 @@
+"""
+Executor for CPU-bound image work (decoding, hashing, resizing, comparing),
+so it does not block the asyncio event loop
+"""
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import (Executor, ProcessPoolExecutor,
+                                ThreadPoolExecutor)
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from typing import Any, Callable
+
+from app.core import error, metrics
+from app.core.config import settings
+
+
+def _timed_call(func: Callable, *args, **kwargs) -> tuple[float, float, Any]:
+    # time.monotonic is system-wide on linux, so start time is comparable between processes
+    started_at = time.monotonic()
+    result = func(*args, **kwargs)
+    return started_at, time.monotonic() - started_at, result
+
+
+class CPUExecutor:
+    def __init__(self, executor_type: str, workers: int, queue_size: int):
+        self.executor_type = executor_type
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor: Executor = None
+        self._pending = metrics.counter('cpu_executor.pending')
+        self._rejected = metrics.counter('cpu_executor.rejected')
+        self._queue_wait = metrics.timer('cpu_executor.queue_wait')
+        self._run_time = metrics.timer('cpu_executor.run_time')
+
+    @property
+    def capacity(self) -> int:
+        return self.workers + self.queue_size
+
+    @property
+    def threads_per_task(self) -> int:
+        """
+        Threads that one task can use without oversubscribing cores when all workers are busy
+        """
+        return max(1, (os.cpu_count() or 1) // self.workers)
+
+    def _create_executor(self) -> Executor:
+        if self.executor_type == 'process':
+            try:
+                return ProcessPoolExecutor(max_workers=self.workers)
+            except (NotImplementedError, ImportError, OSError):
+                logging.warning('Process pool is not available, CPU executor falls back to thread pool')
+        return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='cpu-executor')
+
+    def start(self) -> None:
+        if self._executor is None:
+            self._executor = self._create_executor()
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        Run function in executor. Function and arguments need to be picklable for process pool
+        """
+        self.start()
+        if self._pending.value >= self.capacity:
+            self._rejected.inc()
+            raise error.ExecutorOverloaded()
+        self._pending.inc()
+        submitted_at = time.monotonic()
+        try:
+            started_at, run_time, result = await asyncio.get_running_loop().run_in_executor(
+                self._executor,
+                partial(_timed_call, func, *args, **kwargs),
+            )
+        except BrokenProcessPool as e:
+            # one of workers died (e.g. killed by OOM), pool can not be used anymore
+            self.shutdown()
+            raise e
+        finally:
+            self._pending.dec()
+        self._queue_wait.observe(max(0.0, started_at - submitted_at))
+        self._run_time.observe(run_time)
+        metrics.timer(f'cpu_executor.run_time.{func.__name__}').observe(run_time)
+        return result
+
+
+cpu_executor = CPUExecutor(
+    executor_type=settings.CPU_EXECUTOR_TYPE,
+    workers=settings.CPU_EXECUTOR_WORKERS,
+    queue_size=settings.CPU_EXECUTOR_QUEUE_SIZE,
+)
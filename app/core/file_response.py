@@ -0,0 +1,153 @@
+"""
+File response with byte ranges (RFC 7233): single range is sent as 206, several ones as multipart/byteranges.
+
+File body is sent with ASGI zero-copy send extension (os.sendfile) when server supports it,
+otherwise it is read by bounded chunks in threads, so large files are never kept in memory
+"""
+import os
+import re
+import stat
+import uuid
+from typing import Optional
+
+import anyio
+from fastapi.responses import FileResponse
+from starlette.datastructures import Headers
+from starlette.types import Receive, Scope, Send
+
+ZERO_COPY_EXTENSION = 'http.response.zerocopysend'
+# more ranges (after merging of overlapped ones) are ignored and the whole file is sent
+MAX_RANGES = 16
+RANGE_SPEC_PATTERN = re.compile(r'(\d*)-(\d*)', re.ASCII)
+
+
+def parse_range(value: str, size: int) -> Optional[list[tuple[int, int]]]:
+    """
+    Sorted and merged byte ranges of Range header as (start, end) with inclusive end.
+    None if header is invalid and has to be ignored, empty list if none of ranges is satisfiable
+    """
+    unit, _, specs = value.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        if not (match := RANGE_SPEC_PATTERN.fullmatch(spec.strip())) or match.groups() == ('', ''):
+            return None
+        first, last = match.groups()
+        if not first:
+            # suffix range of the last bytes
+            if int(last) and size:
+                ranges.append((max(size - int(last), 0), size - 1))
+            continue
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start < size:
+            ranges.append((start, min(int(last), size - 1) if last else size - 1))
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged if len(merged) <= MAX_RANGES else None
+
+
+def is_range_fresh(if_range: Optional[str], etag: Optional[str], last_modified: Optional[str]) -> bool:
+    """
+    If-Range check, ranges of changed file are not sent. Entity tags are compared strongly, so weak ones never match
+    """
+    if if_range is None:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        return if_range == etag and not etag.startswith('W/')
+    return if_range == last_modified
+
+
+class RangeFileResponse(FileResponse):
+    def __init__(self, *args, chunk_size: int = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if chunk_size:
+            self.chunk_size = chunk_size
+
+    async def _stat(self) -> os.stat_result:
+        try:
+            stat_result = await anyio.to_thread.run_sync(os.stat, self.path)
+        except FileNotFoundError:
+            raise RuntimeError(f'File at path {self.path} does not exist.')
+        if not stat.S_ISREG(stat_result.st_mode):
+            raise RuntimeError(f'File at path {self.path} is not a file.')
+        return stat_result
+
+    async def _send_file_range(self, scope: Scope, send: Send, file, start: int, count: int, more_body: bool) -> None:
+        if ZERO_COPY_EXTENSION in scope.get('extensions', {}):
+            await send({
+                'type': ZERO_COPY_EXTENSION,
+                'file': file.wrapped,
+                'offset': start,
+                'count': count,
+                'more_body': more_body,
+            })
+            return
+        await file.seek(start)
+        while count:
+            chunk = await file.read(min(self.chunk_size, count))
+            if not chunk:
+                raise RuntimeError(f'File at path {self.path} was truncated while it was sent.')
+            count -= len(chunk)
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': more_body or count > 0})
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if self.stat_result is None:
+            self.stat_result = await self._stat()
+            self.set_stat_headers(self.stat_result)
+        size = self.stat_result.st_size
+        self.headers['accept-ranges'] = 'bytes'
+        request_headers = Headers(scope=scope)
+        ranges = None
+        if self.status_code == 200 and 'range' in request_headers and is_range_fresh(
+                request_headers.get('if-range'), self.headers.get('etag'), self.headers.get('last-modified')
+        ):
+            ranges = parse_range(request_headers['range'], size)
+        parts = []
+        if ranges == []:
+            self.status_code = 416
+            self.headers['content-range'] = f'bytes */{size}'
+            self.headers['content-length'] = '0'
+            del self.headers['content-type']
+        elif ranges and len(ranges) == 1:
+            self.status_code = 206
+            (start, end), = ranges
+            self.headers['content-range'] = f'bytes {start}-{end}/{size}'
+            self.headers['content-length'] = str(end - start + 1)
+            parts = [(b'', start, end - start + 1)]
+        elif ranges:
+            self.status_code = 206
+            boundary = uuid.uuid4().hex
+            content_type = self.headers['content-type']
+            self.headers['content-type'] = f'multipart/byteranges; boundary={boundary}'
+            parts = [(
+                (b'\r\n' if n else b'') + f'--{boundary}\r\nContent-Type: {content_type}\r\n'
+                f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n'.encode(),
+                start,
+                end - start + 1,
+            ) for n, (start, end) in enumerate(ranges)]
+            closing = f'\r\n--{boundary}--\r\n'.encode()
+            self.headers['content-length'] = str(sum(len(it) + count for it, _, count in parts) + len(closing))
+        else:
+            parts = [(b'', 0, size)]
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+        if self.send_header_only or not any(count for _, _, count in parts):
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        else:
+            async with await anyio.open_file(self.path, mode='rb') as file:
+                for prefix, start, count in parts:
+                    if prefix:
+                        await send({'type': 'http.response.body', 'body': prefix, 'more_body': True})
+                    # body of multipart response is finished by closing boundary
+                    more_body = bool(prefix) or (prefix, start, count) != parts[-1]
+                    await self._send_file_range(scope, send, file, start, count, more_body)
+                if parts[-1][0]:
+                    await send({'type': 'http.response.body', 'body': closing, 'more_body': False})
+        if self.background is not None:
+            await self.background()
@@ -0,0 +1,44 @@
+"""
+Registry of algorithms used for decoded pixels hashing.
+Version need to be increased when hashed data changes for the same algorithm (e.g. another decoding flags),
+so stored hashes of the previous version are rehashed
+"""
+import hashlib
+from dataclasses import dataclass
+from functools import partial
+from typing import Any, Callable
+
+
+@dataclass(frozen=True)
+class HashAlgorithm:
+    name: str
+    version: int
+    factory: Callable[[], Any]
+
+    def hexdigest(self, buffer) -> str:
+        h = self.factory()
+        h.update(buffer)
+        return h.hexdigest()
+
+
+ALGORITHMS: dict[str, HashAlgorithm] = {}
+
+
+def register(algorithm: HashAlgorithm) -> HashAlgorithm:
+    ALGORITHMS[algorithm.name] = algorithm
+    return algorithm
+
+
+def get_algorithm(name: str) -> HashAlgorithm:
+    if name not in ALGORITHMS:
+        raise ValueError(f'Hash algorithm {name} is not one of registered {tuple(ALGORITHMS)}')
+    return ALGORITHMS[name]
+
+
+register(HashAlgorithm(name='md5', version=1, factory=hashlib.md5))
+register(HashAlgorithm(name='sha1', version=1, factory=hashlib.sha1))
+register(HashAlgorithm(name='sha256', version=1, factory=hashlib.sha256))
+register(HashAlgorithm(name='sha512', version=1, factory=hashlib.sha512))
+register(HashAlgorithm(name='sha3_256', version=1, factory=hashlib.sha3_256))
+register(HashAlgorithm(name='blake2b', version=1, factory=partial(hashlib.blake2b, digest_size=32)))
+register(HashAlgorithm(name='blake2s', version=1, factory=hashlib.blake2s))
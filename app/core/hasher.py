@@ -1,10 +1,88 @@
 import hashlib
+import mmap
 
 import cv2
 import numpy as np
 
+from app.core import hash_algorithms
 
-def get_image_hash(bytes_file_data: bytes) -> str:
-    return hashlib.md5(
-        np.array(cv2.imdecode(np.frombuffer(bytes_file_data, dtype=np.uint8), cv2.IMREAD_COLOR))
-    ).hexdigest()
+FILE_DIGEST_SIZE = 32
+DEFAULT_HASH_ALGORITHM = 'md5'
+
+
+def new_file_digest():
+    return hashlib.blake2b(digest_size=FILE_DIGEST_SIZE)
+
+
+def get_file_digest(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    digest = new_file_digest()
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+PERCEPTUAL_HASH_SIZE = 8
+PERCEPTUAL_HASH_DCT_SIZE = 32
+
+
+def _decode(buffer: np.ndarray) -> np.ndarray:
+    decoded = cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+    if decoded is None:
+        raise ValueError('image data can not be decoded')
+    return decoded
+
+
+def _decode_file(file_path: str) -> np.ndarray:
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        buffer = np.frombuffer(mm, dtype=np.uint8)
+        try:
+            return _decode(buffer)
+        finally:
+            # mmap can not be closed while numpy array still exports its buffer
+            del buffer
+
+
+def _get_decoded_hash(decoded: np.ndarray, algorithm: str = DEFAULT_HASH_ALGORITHM) -> str:
+    # hash pixels buffer itself through memoryview without copying
+    return hash_algorithms.get_algorithm(algorithm).hexdigest(memoryview(np.ascontiguousarray(decoded)).cast('B'))
+
+
+def _get_perceptual_hash(decoded: np.ndarray) -> int:
+    """
+    64-bit DCT based perceptual hash (pHash) as signed integer to fit into postgres bigint
+    """
+    gray = cv2.cvtColor(decoded, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(
+        gray, (PERCEPTUAL_HASH_DCT_SIZE, PERCEPTUAL_HASH_DCT_SIZE), interpolation=cv2.INTER_AREA
+    ).astype(np.float32)
+    low_frequencies = cv2.dct(small)[:PERCEPTUAL_HASH_SIZE, :PERCEPTUAL_HASH_SIZE]
+    bits = np.packbits((low_frequencies > np.median(low_frequencies)).flatten())
+    return int(bits.view('>i8')[0])
+
+
+def hamming_distance(hash_1: int, hash_2: int) -> int:
+    return ((hash_1 ^ hash_2) & 0xFFFFFFFFFFFFFFFF).bit_count()
+
+
+def get_image_hash(bytes_file_data: bytes, algorithm: str = DEFAULT_HASH_ALGORITHM) -> str:
+    return _get_decoded_hash(_decode(np.frombuffer(bytes_file_data, dtype=np.uint8)), algorithm)
+
+
+def get_image_file_hash(file_path: str, algorithm: str = DEFAULT_HASH_ALGORITHM) -> str:
+    return _get_decoded_hash(_decode_file(file_path), algorithm)
+
+
+def get_image_file_perceptual_hash(file_path: str) -> int:
+    return _get_perceptual_hash(_decode_file(file_path))
+
+
+def get_image_file_hashes(
+        file_path: str,
+        algorithms: tuple[str, ...] = (DEFAULT_HASH_ALGORITHM,)
+) -> tuple[dict[str, str], int]:
+    """
+    Get exact pixels hashes by each algorithm and perceptual hash with a single decoding
+    """
+    decoded = _decode_file(file_path)
+    return {alg: _get_decoded_hash(decoded, alg) for alg in algorithms}, _get_perceptual_hash(decoded)
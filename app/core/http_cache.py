@@ -0,0 +1,52 @@
+"""
+HTTP validators of image files. Stored image content never changes, so ETags are derived from digest of its file
+bytes and rendition parameters, conditional requests are answered without touching files
+"""
+from typing import Optional
+
+from app import models
+from app.core.config import settings
+
+
+def get_file_tag(image: models.Image) -> str:
+    """
+    Base of image files ETags. Rows without file digest (legacy ones or with file missing at digest backfill)
+    are tagged by pixels hash and id, file of the stored image row never changes
+    """
+    return image.file_digest or f'{image.hash}-{image.id}'
+
+
+def get_etag(file_digest: str, size: tuple[int, int] = None, file_type: str = None, quality: int = 0) -> str:
+    """
+    Strong ETag of original file by its digest or weak ETag of thumbnail (rendition) by original digest and its
+    parameters. Pixels hash can not be used, files with the same pixels can have different bytes (metadata, encoding).
+    Regenerated thumbnail can differ byte for byte (e.g. it is resized from other cached source), so its ETag is
+    only good for If-None-Match, not for If-Range
+    """
+    if size is None:
+        return f'"{file_digest}"'
+    quality_suffix = f'-q{quality}' if quality else ''
+    return f'W/"{file_digest}-{size[0]}x{size[1]}-{file_type}{quality_suffix}"'
+
+
+def _get_opaque_tag(etag: str) -> str:
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def is_not_modified(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    If-None-Match check, it uses weak comparison, so W/ prefix of tags is ignored
+    """
+    if not if_none_match:
+        return False
+    tags = [it.strip() for it in if_none_match.split(',')]
+    return '*' in tags or _get_opaque_tag(etag) in map(_get_opaque_tag, tags)
+
+
+def get_cache_headers(etag: str, immutable: bool) -> dict:
+    """
+    URLs by image id are content-addressed and cached forever, URLs by image name are revalidated by ETag
+    since name can be moved to other image
+    """
+    cache_control = f'public, max-age={settings.FILE_CACHE_MAX_AGE}, immutable' if immutable else 'no-cache'
+    return {'ETag': etag, 'Cache-Control': cache_control}
@@ -1,25 +1,242 @@
-from PIL import Image, ImageChops, ImageDraw
-
-
-def are_images_equal(img_1_path, img_2_path):
-    img1 = Image.open(img_1_path)
-    img2 = Image.open(img_2_path)
-    diff = ImageChops.difference(img1, img2)
-    return img1.size == img2.size and (diff.getbbox() is None)
-
-
-def get_compare_image(img_1_path, img_2_path, output_path):
-    img1 = Image.open(img_1_path)
-    img2 = Image.open(img_2_path)
-    diff = ImageChops.difference(img1, img2)
-    pix = diff.load()
-    draw = ImageDraw.Draw(diff)
-    width, height = diff.size
-    for x in range(width):
-        for y in range(height):
-            r = pix[x, y][0]
-            g = pix[x, y][1]
-            b = pix[x, y][2]
-            sr = 0 if r or g or b else 255
-            draw.point((x, y), (sr, sr, sr))
-    diff.convert('RGB').save(output_path, 'JPEG')
+"""
+Pixels comparison engine, the whole diff is computed with array operations over decoded images
+"""
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional, Sequence, Union
+
+import cv2
+import numpy as np
+from PIL import Image, ImageMode
+
+Tolerance = Union[int, Sequence[int]]
+
+
+@dataclass(frozen=True)
+class DiffStats:
+    changed_pixels: int
+    total_pixels: int
+    # (left, upper, right, lower) like PIL getbbox, None when nothing is changed
+    bbox: Optional[tuple[int, int, int, int]]
+    max_delta: int
+
+    @property
+    def equal(self) -> bool:
+        return self.changed_pixels == 0
+
+
+@dataclass(frozen=True)
+class ImageDiff:
+    # True for pixels where any channel differs more than tolerance
+    mask: np.ndarray
+    stats: DiffStats
+
+
+def load_pixels(img_1_path, img_2_path) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Decode both images to arrays of the same mode, alpha is kept if any of them has it
+    """
+    with Image.open(img_1_path) as img1, Image.open(img_2_path) as img2:
+        mode = 'RGBA' if 'A' in img1.getbands() or 'A' in img2.getbands() else 'RGB'
+        return tuple(np.asarray(it if it.mode == mode else it.convert(mode)) for it in (img1, img2))
+
+
+def _get_channels_max(image: np.ndarray) -> np.ndarray:
+    if image.ndim == 2:
+        return image
+    channels = cv2.split(image)
+    result = channels[0]
+    for channel in channels[1:]:
+        result = cv2.max(result, channel)
+    return result
+
+
+def diff(pixels_1: np.ndarray, pixels_2: np.ndarray, tolerance: Tolerance = 0) -> ImageDiff:
+    """
+    Tolerance is the maximum allowed absolute difference of channel value,
+    single one for all channels or one per channel (channels without it are compared exactly)
+    """
+    if pixels_1.shape != pixels_2.shape:
+        raise ValueError('images sizes are different')
+    delta = cv2.absdiff(pixels_1, pixels_2)
+    channels = 1 if delta.ndim == 2 else delta.shape[2]
+    tolerances = list(tolerance[:channels]) if np.ndim(tolerance) else [tolerance] * channels
+    # saturated subtraction leaves non-zero values only in channels that are over their tolerance
+    excess = _get_channels_max(cv2.subtract(delta, tuple(map(float, tolerances + [0] * (4 - len(tolerances))))))
+    x, y, width, height = cv2.boundingRect(excess)
+    return ImageDiff(mask=excess > 0, stats=DiffStats(
+        changed_pixels=cv2.countNonZero(excess),
+        total_pixels=excess.size,
+        bbox=(x, y, x + width, y + height) if width else None,
+        max_delta=int(cv2.minMaxLoc(delta.reshape(delta.shape[0], -1))[1]) if delta.size else 0,
+    ))
+
+
+def are_images_equal(img_1_path, img_2_path, tolerance: Tolerance = 0):
+    pixels_1, pixels_2 = load_pixels(img_1_path, img_2_path)
+    return pixels_1.shape == pixels_2.shape and diff(pixels_1, pixels_2, tolerance).stats.equal
+
+
+def get_compare_image(img_1_path, img_2_path, tolerance: Tolerance = 0) -> tuple[bytes, DiffStats]:
+    """
+    Encode black and white diff mask as JPEG in memory: changed pixels are black, the same ones are white
+    """
+    image_diff = diff(*load_pixels(img_1_path, img_2_path), tolerance)
+    pixels = np.logical_not(image_diff.mask).view(np.uint8) * np.uint8(255)
+    _, encoded = cv2.imencode('.jpg', pixels)
+    return encoded.tobytes(), image_diff.stats
+
+
+@dataclass(frozen=True)
+class CompareMetrics:
+    ssim: float
+    # None when images are identical, PSNR is infinite then
+    psnr: Optional[float]
+    mean_abs_error: float
+    max_abs_error: int
+
+
+IDENTICAL_METRICS = CompareMetrics(ssim=1.0, psnr=None, mean_abs_error=0.0, max_abs_error=0)
+
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+
+
+def get_working_size(size: tuple[int, int], max_side: int = None) -> tuple[int, int]:
+    if not max_side or max(size) <= max_side:
+        return size
+    k = max_side / max(size)
+    return max(1, round(size[0] * k)), max(1, round(size[1] * k))
+
+
+def load_working_copy(path, size: tuple[int, int]) -> np.ndarray:
+    """
+    Decode image as RGB of the size, JPEG is decoded right away at reduced scale when it is possible
+    """
+    with Image.open(path) as image:
+        if image.format == 'JPEG':
+            image.draft('RGB', size)
+        pixels = np.asarray(image if image.mode == 'RGB' else image.convert('RGB'))
+    if (pixels.shape[1], pixels.shape[0]) != size:
+        pixels = cv2.resize(pixels, size, interpolation=cv2.INTER_AREA)
+    return pixels
+
+
+def _get_ssim(gray_1: np.ndarray, gray_2: np.ndarray) -> float:
+    """
+    Mean SSIM with 11x11 gaussian window (sigma 1.5) like in Wang et al. 2004
+    """
+    x = gray_1.astype(np.float32)
+    y = gray_2.astype(np.float32)
+
+    def blur(it):
+        return cv2.GaussianBlur(it, (11, 11), 1.5)
+
+    mu_x, mu_y = blur(x), blur(y)
+    mu_xx, mu_yy, mu_xy = mu_x * mu_x, mu_y * mu_y, mu_x * mu_y
+    sigma_xx = blur(x * x) - mu_xx
+    sigma_yy = blur(y * y) - mu_yy
+    sigma_xy = blur(x * y) - mu_xy
+    ssim_map = ((2 * mu_xy + SSIM_C1) * (2 * sigma_xy + SSIM_C2)) / (
+        (mu_xx + mu_yy + SSIM_C1) * (sigma_xx + sigma_yy + SSIM_C2)
+    )
+    return float(ssim_map.mean())
+
+
+def get_metrics(pixels_1: np.ndarray, pixels_2: np.ndarray) -> CompareMetrics:
+    """
+    SSIM of luminance, PSNR and absolute errors of all channels of 8-bit images
+    """
+    if pixels_1.shape != pixels_2.shape:
+        raise ValueError('images sizes are different')
+    mse = cv2.norm(pixels_1, pixels_2, cv2.NORM_L2SQR) / pixels_1.size
+    return CompareMetrics(
+        ssim=_get_ssim(cv2.cvtColor(pixels_1, cv2.COLOR_RGB2GRAY), cv2.cvtColor(pixels_2, cv2.COLOR_RGB2GRAY)),
+        psnr=float(10 * np.log10(255 ** 2 / mse)) if mse else None,
+        mean_abs_error=cv2.norm(pixels_1, pixels_2, cv2.NORM_L1) / pixels_1.size,
+        max_abs_error=int(cv2.norm(pixels_1, pixels_2, cv2.NORM_INF)),
+    )
+
+
+def get_compare_metrics(img_1_path, img_2_path, original_size=None, max_side: int = None) -> CompareMetrics:
+    """
+    Compare working copies downscaled to fit max_side. Paths can be of thumbnails,
+    then original size (the same for both images) need to be passed
+    """
+    if original_size is None:
+        with Image.open(img_1_path) as img1, Image.open(img_2_path) as img2:
+            if img1.size != img2.size:
+                raise ValueError('images sizes are different')
+            original_size = img1.size
+    size = get_working_size(original_size, max_side)
+    return get_metrics(load_working_copy(img_1_path, size), load_working_copy(img_2_path, size))
+
+
+def get_decoded_size(images: list[tuple[int, int, str]], with_metrics: bool = False, max_side: int = None) -> int:
+    """
+    Bytes of pixels held by compare_many for images of (width, height, mode): all of them are decoded as 8-bit RGB,
+    or as RGBA when any image has alpha, working copies of metrics are RGB
+    """
+    channels = 4 if any('A' in ImageMode.getmode(mode).bands for _, _, mode in images) else 3
+    size = sum(width * height * channels for width, height, _ in images)
+    if with_metrics:
+        size += sum(
+            working_width * working_height * 3 for working_width, working_height in (
+                get_working_size((width, height), max_side) for width, height, _ in images
+            )
+        )
+    return size
+
+
+def _decode(path) -> np.ndarray:
+    with Image.open(path) as image:
+        mode = 'RGBA' if 'A' in image.getbands() else 'RGB'
+        return np.asarray(image if image.mode == mode else image.convert(mode))
+
+
+def _is_changed(pixels_1: np.ndarray, pixels_2: np.ndarray, tolerance: int) -> bool:
+    # infinity norm of difference is the maximum absolute channel delta, delta array is not allocated
+    return cv2.norm(pixels_1, pixels_2, cv2.NORM_INF) > tolerance
+
+
+def compare_many(
+        paths: list,
+        pairs: list[tuple[int, int]],
+        tolerance: int = 0,
+        with_metrics: bool = False,
+        max_side: int = None,
+        threads: int = 1,
+) -> list[tuple[bool, Optional[CompareMetrics]]]:
+    """
+    Compare pairs of paths indexes decoding every image once. Decoding and comparing run in threads
+    (decoders and array operations release GIL), their amount need to fit cores share of one executor worker.
+    Images of different sizes are not equal and have no metrics
+    """
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        pixels = list(pool.map(_decode, paths))
+        if any(it.shape[2] == 4 for it in pixels):
+            pixels = [cv2.cvtColor(it, cv2.COLOR_RGB2RGBA) if it.shape[2] == 3 else it for it in pixels]
+        results = {}
+        same_size = []
+        for i, j in pairs:
+            if pixels[i].shape != pixels[j].shape:
+                results[(i, j)] = (False, None)
+            else:
+                same_size.append((i, j))
+        for pair, changed in zip(same_size, pool.map(
+            lambda it: _is_changed(pixels[it[0]], pixels[it[1]], tolerance), same_size
+        )):
+            results[pair] = (not changed, None)
+        if with_metrics:
+            def get_working_copy(i):
+                height, width = pixels[i].shape[:2]
+                size = get_working_size((width, height), max_side)
+                rgb = pixels[i][:, :, :3]
+                return rgb if size == (width, height) else cv2.resize(rgb, size, interpolation=cv2.INTER_AREA)
+
+            working = dict(zip(range(len(pixels)), pool.map(get_working_copy, range(len(pixels)))))
+            for pair, metrics in zip(same_size, pool.map(
+                lambda it: get_metrics(working[it[0]], working[it[1]]), same_size
+            )):
+                results[pair] = (results[pair][0], metrics)
+    return [results[pair] for pair in pairs]
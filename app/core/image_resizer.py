@@ -1,38 +1,210 @@
+import math
+import os
+
 from PIL import Image
 
 from app.core import error
+from app.core.config import settings
+
+# decoded image is reduced with box filter while it stays at least this times bigger than target size
+REDUCING_GAP = 2
+
+
+def open_for_size(input_path, size):
+    """
+    Open image for downscaling to size. JPEG is decoded right away at 1/2, 1/4 or 1/8 scale
+    if it is still not smaller than size
+    """
+    image = Image.open(input_path)
+    if image.format == 'JPEG':
+        image.draft(image.mode, size)
+    return image
+
+
+def get_resampling_mode(image):
+    """
+    Palette and bilevel pixels can not be averaged, such images are resampled as RGB(A) and L
+    """
+    if image.mode in ('P', 'PA'):
+        return 'RGBA' if image.mode == 'PA' or 'transparency' in image.info else 'RGB'
+    if image.mode == '1':
+        return 'L'
+    return image.mode
+
+
+def reduce_for_size(image, size):
+    if (mode := get_resampling_mode(image)) != image.mode:
+        image = image.convert(mode)
+    factor = min(
+        image.size[0] // (max(size[0], 1) * REDUCING_GAP),
+        image.size[1] // (max(size[1], 1) * REDUCING_GAP),
+    )
+    # 16-bit integer images are not supported by reduce, resize still works for them
+    return image.reduce(factor) if factor >= 2 and not image.mode.startswith('I;16') else image
+
+
+# modes that can be saved as JPEG, others are converted to RGB
+JPEG_MODES = ('1', 'L', 'RGB', 'CMYK')
+
+
+def can_encode(file_type):
+    return Image.registered_extensions().get(f'.{file_type}') in Image.SAVE
 
 
 def resize_image(
         input_path,
         output_path,
         size,
-        is_grayscale=False
+        is_grayscale=False,
+        quality=None,
 ):
-    original_image = Image.open(input_path)
-    resized_image = original_image.resize(size)
+    """
+    Output format is defined by output path extension, quality is used by lossy formats encoders
+    """
+    original_image = open_for_size(input_path, size)
+    resized_image = original_image
+    if original_image.size != tuple(size):
+        resized_image = reduce_for_size(original_image, size).resize(size)
     if is_grayscale:
         resized_image = resized_image.convert("L")
-    resized_image.save(output_path)
+    output_format = Image.registered_extensions().get(os.path.splitext(output_path)[1].lower())
+    if output_format == 'JPEG' and resized_image.mode not in JPEG_MODES:
+        resized_image = resized_image.convert('RGB')
+    resized_image.save(output_path, **({'quality': quality} if quality else {}))
+
+
+def resize_many(
+        input_path,
+        outputs,
+        is_grayscale=False
+):
+    """
+    Decode image once and resize it to every (output_path, size) with progressive downscale chain:
+    each size is resized from the smallest already produced rendition that is not smaller than it
+    """
+    if not outputs:
+        return
+    largest_size = (max(it[1][0] for it in outputs), max(it[1][1] for it in outputs))
+    with open_for_size(input_path, largest_size) as original_image:
+        original_image.load()
+        renditions = [original_image]
+        for output_path, size in sorted(outputs, key=lambda it: it[1][0] * it[1][1], reverse=True):
+            source = next(
+                (it for it in reversed(renditions) if it.size[0] >= size[0] and it.size[1] >= size[1]),
+                original_image
+            )
+            resized_image = reduce_for_size(source, size).resize(size)
+            renditions.append(resized_image)
+            if is_grayscale:
+                resized_image = resized_image.convert("L")
+            resized_image.save(output_path)
 
 
-def get_scaled_size(input_image_path, scale):
+def get_size(input_image_path):
     with Image.open(input_image_path) as original_image:
-        return (int(elem / scale) for elem in original_image.size)
+        return original_image.size
 
 
-def get_new_size(input_image_path, width, height):
-    MAX_SIZE = 10000
-    if not (width and height):
+# bytes per band of decoded pixels, other modes keep one byte per band
+MODE_BAND_BYTES = {'I': 4, 'F': 4, 'I;16': 2, 'I;16B': 2, 'I;16L': 2, 'I;16N': 2}
+
+
+def get_image_info(input_image_path):
+    """
+    Intrinsic image metadata that is read from the header without decoding pixels.
+    Not identified or broken image is a ValueError like in hasher, so upload of it is a client error
+    """
+    try:
         with Image.open(input_image_path) as original_image:
-            if not width and not height:
-                raise ValueError('width or height or both are required')
-            elif not width:
-                k = height / original_image.size[1]
-                width = int(k * original_image.size[0])
-            elif not height:
-                k = width / original_image.size[0]
-                height = int(k * original_image.size[1])
+            width, height = original_image.size
+            channels = len(original_image.getbands())
+            return dict(
+                width=width,
+                height=height,
+                mode=original_image.mode,
+                channels=channels,
+                frames=getattr(original_image, 'n_frames', 1),
+                decoded_size=width * height * channels * MODE_BAND_BYTES.get(original_image.mode, 1),
+            )
+    except OSError as e:
+        # PIL.UnidentifiedImageError is OSError too
+        raise ValueError('image data can not be decoded') from e
+
+
+def get_scaled_size(input_image_path, scale, original_size=None):
+    original_size = original_size or get_size(input_image_path)
+    return (int(elem / scale) for elem in original_size)
+
+
+def snap_length(length):
+    """
+    Round length up to the nearest allowed size of THUMBNAIL_SIZE_SNAPPING policy
+    """
+    if settings.THUMBNAIL_SIZE_SNAPPING == 'buckets':
+        return next((it for it in settings.THUMBNAIL_SIZE_BUCKETS if it >= length), length)
+    if settings.THUMBNAIL_SIZE_SNAPPING == 'ladder':
+        base, ratio = settings.THUMBNAIL_SIZE_LADDER_BASE, settings.THUMBNAIL_SIZE_LADDER_RATIO
+        if length <= base:
+            return base
+        step = math.floor(math.log(length / base, ratio))
+        while round(base * ratio ** step) < length:
+            step += 1
+        return round(base * ratio ** step)
+    return length
+
+
+def snap_size(original_size, width, height):
+    """
+    Snap size with aspect ratio of original by its longer side, so the other side is derived the same way
+    for any request of this ratio. Snapping does not upscale over original size
+    """
+    if settings.THUMBNAIL_SIZE_SNAPPING == 'none':
+        return width, height
+    if original_size is None or abs(width * original_size[1] - height * original_size[0]) > max(original_size):
+        return snap_length(width), snap_length(height)
+    side = 0 if original_size[0] >= original_size[1] else 1
+    length = snap_length((width, height)[side])
+    if (width, height)[side] <= original_size[side]:
+        length = min(length, original_size[side])
+    other_length = max(1, round(length / original_size[side] * original_size[1 - side]))
+    return (length, other_length) if side == 0 else (other_length, length)
+
+
+def fit_size(original_size, width, height):
+    MAX_SIZE = 10000
+    if not width and not height:
+        raise ValueError('width or height or both are required')
+    elif not width:
+        k = height / original_size[1]
+        width = int(k * original_size[0])
+    elif not height:
+        k = width / original_size[0]
+        height = int(k * original_size[1])
     if width > MAX_SIZE or height > MAX_SIZE or width < 0 or height < 0:
         raise error.ResizingSizeError()
+    width, height = snap_size(original_size, width, height)
+    if width > MAX_SIZE or height > MAX_SIZE:
+        raise error.ResizingSizeError()
     return width, height
+
+
+def get_new_size(input_image_path, width, height, original_size=None):
+    """
+    Original size stored in db can be passed, so image file is not opened
+    """
+    if original_size is None and not (width and height and settings.THUMBNAIL_SIZE_SNAPPING == 'none'):
+        original_size = get_size(input_image_path)
+    return fit_size(original_size, width, height)
+
+
+def get_new_sizes(input_image_path, sizes, original_size=None):
+    """
+    Get new size for each of (scale, width, height) reading image header at most once
+    """
+    original_size = original_size or get_size(input_image_path)
+    return [
+        fit_size(original_size, *(
+            (int(elem / scale) for elem in original_size) if scale else (width, height)
+        ))
+        for scale, width, height in sizes
+    ]
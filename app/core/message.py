@@ -12,9 +12,11 @@ ERROR_IMAGE_NAME_UNIQUE = 'Image name need to be unique'
 ERROR_STORAGE_SAVE = 'Saving data to storage failed'
 ERROR_RESIZING_SIZE = 'Resizing size is overflowed or negative'
 ERROR_FILE_NOT_FOUND = 'File not found'
+ERROR_EXECUTOR_OVERLOADED = 'Too many images are processing now, try again later'
 
 """
 MODELS
 """
 MODEL_IMAGE = 'Image'
 MODEL_THUMBNAIL = 'Thumbnail'
+MODEL_RENDITION = 'Rendition'
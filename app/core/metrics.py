@@ -0,0 +1,74 @@
+"""
+In-process metrics registry, values are collected per worker
+"""
+from collections import deque
+from typing import Union
+
+SAMPLES_AMOUNT = 1024
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: int = 1) -> None:
+        self.value -= amount
+
+    def snapshot(self) -> Union[int, float]:
+        return self.value
+
+
+class Timer:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.samples = deque(maxlen=SAMPLES_AMOUNT)
+
+    def observe(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+
+    @staticmethod
+    def _percentile(sorted_samples: list, percent: float) -> float:
+        if not sorted_samples:
+            return 0.0
+        return sorted_samples[min(len(sorted_samples) - 1, int(len(sorted_samples) * percent))]
+
+    def snapshot(self) -> dict:
+        samples = sorted(self.samples)
+        return {
+            'count': self.count,
+            'total': self.total,
+            'avg': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self._percentile(samples, 0.5),
+            'p95': self._percentile(samples, 0.95),
+            'p99': self._percentile(samples, 0.99),
+        }
+
+
+_registry: dict[str, Union[Counter, Timer]] = {}
+
+
+def _get_or_create(name: str, metric_class):
+    if name not in _registry:
+        _registry[name] = metric_class()
+    return _registry[name]
+
+
+def counter(name: str) -> Counter:
+    return _get_or_create(name, Counter)
+
+
+def timer(name: str) -> Timer:
+    return _get_or_create(name, Timer)
+
+
+def snapshot() -> dict:
+    return {name: metric.snapshot() for name, metric in sorted(_registry.items())}
@@ -0,0 +1,134 @@
+"""
+In-memory index of images perceptual hashes for Hamming distance search
+"""
+import asyncio
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterable, Awaitable, Callable, Iterable, Optional
+
+from app.core.hasher import hamming_distance
+
+# rows are stamped with transaction start time, so long transactions may commit rows older than the watermark
+SYNC_OVERLAP = timedelta(minutes=1)
+
+# (id, phash, updated_at)
+Row = tuple[Any, Optional[int], datetime]
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree, metric tree that allows to skip subtrees which can not contain hashes within radius
+    """
+
+    def __init__(self):
+        self.root: Optional[list] = None
+        self.nodes: dict[int, list] = {}
+
+    def __len__(self) -> int:
+        return sum(len(node[1]) for node in self.nodes.values())
+
+    def add(self, value: int, item: Any) -> None:
+        # node is [value, items, children by distance]
+        if (node := self.nodes.get(value)) is not None:
+            node[1].add(item)
+            return
+        new_node = [value, {item}, {}]
+        self.nodes[value] = new_node
+        if self.root is None:
+            self.root = new_node
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(value, node[0])
+            if (child := node[2].get(distance)) is None:
+                node[2][distance] = new_node
+                return
+            node = child
+
+    def discard(self, value: int, item: Any) -> None:
+        # node itself is kept, it is still needed as a routing point for its children
+        if (node := self.nodes.get(value)) is not None:
+            node[1].discard(item)
+
+    def search(self, value: int, max_distance: int) -> list[tuple[int, Any]]:
+        result = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                result.extend((distance, item) for item in node[1])
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return sorted(result, key=lambda it: it[0])
+
+
+class PerceptualHashIndex:
+    """
+    Per worker index, it is loaded by keyset batches and then synced with db by images updated_at watermark,
+    so images added or rehashed by other workers are found after sync interval. Deleted images are found by
+    checking a batch of indexed ids on every sync, until then search results need to be checked against db
+    """
+
+    def __init__(self):
+        self.tree = BKTree()
+        self.values: dict[Any, int] = {}
+        self.loaded = False
+        self._watermark: Optional[datetime] = None
+        self._unchecked_ids: list = []
+        self._lock = asyncio.Lock()
+
+    def add(self, value: Optional[int], item_id: Any) -> None:
+        # rehashed item is moved to its new node, item without value is removed
+        if self.values.get(item_id) == value:
+            return
+        self.discard(item_id)
+        if value is not None:
+            self.tree.add(value, item_id)
+            self.values[item_id] = value
+
+    def discard(self, item_id: Any) -> None:
+        if (value := self.values.pop(item_id, None)) is not None:
+            self.tree.discard(value, item_id)
+
+    async def load(self, watermark: Optional[datetime], batches: AsyncIterable[Iterable[Row]]) -> None:
+        """
+        Load all (id, phash, updated_at) rows by batches, the watermark is taken before loading,
+        so rows updated while loading are loaded again by the next sync
+        """
+        async with self._lock:
+            async for rows in batches:
+                for item_id, value, _ in rows:
+                    self.add(value, item_id)
+            self._watermark = watermark
+            self.loaded = True
+
+    async def sync(
+            self,
+            load_updates: Callable[[datetime], Awaitable[Iterable[Row]]],
+            get_existing_ids: Callable[[list], Awaitable[set]],
+            check_size: int,
+    ) -> None:
+        """
+        Remove deleted items among the next check_size indexed ids, then load rows updated after the watermark
+        """
+        async with self._lock:
+            if not self._unchecked_ids:
+                self._unchecked_ids = list(self.values)
+            item_ids = [self._unchecked_ids.pop() for _ in range(min(check_size, len(self._unchecked_ids)))]
+            if item_ids:
+                existing_ids = await get_existing_ids(item_ids)
+                for item_id in item_ids:
+                    if item_id not in existing_ids:
+                        self.discard(item_id)
+            updated_after = self._watermark - SYNC_OVERLAP if self._watermark is not None else datetime.min
+            for item_id, value, updated_at in await load_updates(updated_after):
+                self.add(value, item_id)
+                if updated_at is not None and (self._watermark is None or updated_at > self._watermark):
+                    self._watermark = updated_at
+
+    def search(self, value: int, max_distance: int) -> list[tuple[int, Any]]:
+        return self.tree.search(value, max_distance)
+
+
+phash_index = PerceptualHashIndex()
@@ -0,0 +1,70 @@
+"""
+Output format and quality of image files: explicit `format` and `quality` params
+or negotiated by Accept header among RENDITION_FORMATS
+"""
+from typing import Optional
+
+from app import schemas
+from app.core import error, image_resizer, message
+from app.core.config import settings
+
+LOSSLESS_FORMATS = ('png',)
+JPEG_FORMATS = ('jpg', 'jpeg')
+
+
+def get_accepted_types(accept: Optional[str]) -> set[str]:
+    accepted = set()
+    for part in (accept or '').split(','):
+        media_type, *params = [it.strip() for it in part.split(';')]
+        weights = [it.split('=', 1)[1] for it in params if it.replace(' ', '').startswith('q=')]
+        try:
+            if weights and float(weights[0]) <= 0:
+                continue
+        except ValueError:
+            continue
+        accepted.add(media_type.lower())
+    return accepted
+
+
+def negotiate_format(accept: Optional[str], file_type: str) -> str:
+    accepted = get_accepted_types(accept)
+    return next(
+        (it for it in settings.RENDITION_FORMATS if f'image/{it}' in accepted and image_resizer.can_encode(it)),
+        file_type,
+    )
+
+
+def get_quality(file_type: str, quality: int = None) -> int:
+    """
+    Quality is rounded up to one of RENDITION_QUALITY_TIERS, so renditions are shared between clients
+    """
+    if file_type in LOSSLESS_FORMATS:
+        return 0
+    quality = quality or settings.RENDITION_DEFAULT_QUALITY
+    return next((it for it in settings.RENDITION_QUALITY_TIERS if it >= quality), quality)
+
+
+def get_rendition(
+        file_type: str,
+        accept: Optional[str] = None,
+        requested_format: Optional[schemas.RenditionFormats] = None,
+        quality: int = None,
+) -> tuple[str, int]:
+    """
+    Get output file type and quality for stored file type, 0 quality is for encoder defaults
+    """
+    if requested_format is not None:
+        if not image_resizer.can_encode(requested_format.value):
+            raise error.IncorrectDataFormat(
+                allowed_formats=[it for it in schemas.RenditionFormats.values() if image_resizer.can_encode(it)],
+                format=requested_format.value,
+                model=message.MODEL_RENDITION,
+            )
+        output_type = requested_format.value
+    else:
+        output_type = negotiate_format(accept, file_type)
+    if output_type in JPEG_FORMATS and file_type in JPEG_FORMATS:
+        output_type = file_type
+    if output_type == file_type and not quality:
+        return file_type, 0
+    return output_type, get_quality(output_type, quality)
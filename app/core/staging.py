@@ -0,0 +1,46 @@
+import os
+import uuid
+from dataclasses import dataclass
+
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+
+from app.core import error, hasher
+from app.core.config import settings
+
+
+@dataclass
+class StagedFile:
+    path: str
+    size: int
+    digest: str
+
+    def discard(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def get_staging_path() -> str:
+    return os.path.join(settings.STAGING_DIR, str(uuid.uuid4()))
+
+
+async def stage_upload(file: UploadFile, chunk_size: int = None) -> StagedFile:
+    """
+    Write uploaded file to the staging dir chunk by chunk and compute raw bytes digest on the fly,
+    so the whole file is never kept in memory
+    """
+    chunk_size = chunk_size or settings.UPLOAD_CHUNK_SIZE
+    path = get_staging_path()
+    digest = hasher.new_file_digest()
+    size = 0
+    try:
+        with open(path, 'wb') as f:
+            while chunk := await file.read(chunk_size):
+                digest.update(chunk)
+                await run_in_threadpool(f.write, chunk)
+                size += len(chunk)
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        raise error.StorageSaveError()
+    return StagedFile(path=path, size=size, digest=digest.hexdigest())
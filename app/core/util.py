@@ -34,12 +34,28 @@ def save_thumbnail_to_storage(filename, data):
     )
 
 
+def move_to_storage(src_path, dir_path, filename):
+    try:
+        os.replace(src_path, os.path.join(dir_path, filename))
+    except Exception:
+        raise error.StorageSaveError()
+
+
+def move_image_to_storage(src_path, filename):
+    move_to_storage(
+        src_path=src_path,
+        dir_path=settings.STORAGE_DIR,
+        filename=filename
+    )
+
+
 def generate_image_filename(image_id, file_type):
     return f'{str(image_id)}.{file_type}'
 
 
-def generate_thumbnail_filename(image_id, width, height, file_type):
-    return f'{str(image_id)}_{width}x{height}.{file_type}'
+def generate_thumbnail_filename(image_id, width, height, file_type, quality=0):
+    quality_suffix = f'_q{quality}' if quality else ''
+    return f'{str(image_id)}_{width}x{height}{quality_suffix}.{file_type}'
 
 
 def get_image_path(image: models.Image) -> str:
@@ -49,10 +65,21 @@ def get_image_path(image: models.Image) -> str:
     ))
 
 
-def get_thumbnail_path(thumbnail: models.Thumbnail):
+def get_thumbnail_path_by(image_id, width, height, file_type, quality=0):
     return os.path.join(settings.STORAGE_DIR, generate_thumbnail_filename(
+        image_id=image_id,
+        width=width,
+        height=height,
+        file_type=file_type,
+        quality=quality,
+    ))
+
+
+def get_thumbnail_path(thumbnail: models.Thumbnail):
+    return get_thumbnail_path_by(
         image_id=thumbnail.image_id,
         width=thumbnail.width,
         height=thumbnail.height,
-        file_type=thumbnail.file_type
-    ))
+        file_type=thumbnail.file_type,
+        quality=thumbnail.quality,
+    )
@@ -1,9 +1,11 @@
-from typing import Any, Callable, Iterable, List, Type
+import hashlib
+from typing import Any, Callable, Iterable, List, Optional, Type
 from uuid import UUID
 
 from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel
-from sqlalchemy import delete, func, or_, update
+from sqlalchemy import bindparam, delete, func, or_, text, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy.orm import joinedload
@@ -11,7 +13,6 @@ from sqlalchemy.sql.selectable import Select
 
 from app import schemas
 from app.core import error
-from app.db.base_class import Base
 
 
 class DefaultCRUD:
@@ -107,38 +108,163 @@ class DefaultCRUD:
             await self.db_session.rollback()  # noqa
             raise e
 
-    async def _create(self, item: Base, no_return: bool = False) -> Any:
+    def _returning_query(self, q) -> Select:
+        """
+        Wrap INSERT/UPDATE/DELETE statement to get affected model objects with RETURNING in the same round trip
+        """
+        return (
+            select(self.model)
+            .from_statement(q.returning(*self.model.__table__.columns))
+            .execution_options(populate_existing=True)
+        )
+
+    async def _create(self, values: dict, no_return: bool = False) -> Any:
+        q = insert(self.model).values(**values)
         try:
-            self.db_session.add(item)
-            await self.db_session.flush()  # noqa
-            if not no_return:
-                return await self.get(item.id)
+            if no_return:
+                await self.db_session.execute(q)
+                return
+            return (await self.db_session.execute(self._returning_query(q))).scalar_one()
+        except Exception as e:
+            await self.db_session.rollback()  # noqa
+            raise e
+
+    async def _create_many(
+            self,
+            values: List[dict],
+            no_return: bool = False,
+            on_conflict_do_nothing: bool = False,
+    ) -> List:
+        """
+        Create all items with one multi-row INSERT, all values dicts need to have the same keys.
+        With on_conflict_do_nothing only inserted items are returned
+        """
+        if not values:
+            return []
+        q = insert(self.model).values(values)
+        if on_conflict_do_nothing:
+            q = q.on_conflict_do_nothing()
+        try:
+            if no_return:
+                await self.db_session.execute(q)
+                return []
+            return (await self.db_session.execute(self._returning_query(q))).scalars().all()
         except Exception as e:
             await self.db_session.rollback()  # noqa
             raise e
 
     async def _update(self, item_id: UUID, obj_in: Any) -> Any:
-        if not await self.has(item_id):
+        values = obj_in if isinstance(obj_in, dict) else jsonable_encoder(obj_in)
+        q = update(self.model).where(self.model.id == item_id).values(**values)
+        try:
+            item = (await self.db_session.execute(self._returning_query(q))).scalar()
+        except Exception as e:
+            await self.db_session.rollback()  # noqa
+            raise e
+        if item is None:
             raise error.ItemNotFound(model=self.model_name)
+        return item
+
+    async def _update_many(self, values: List[dict]) -> None:
+        """
+        Update items with executemany, each values dict need to contain item id and the same set of fields
+        """
+        if not values:
+            return
+        table = self.model.__table__
+        keys = [k for k in values[0] if k != 'id']
         q = (
-            update(self.model)
-            .where(self.model.id == item_id)
-            .values(**jsonable_encoder(obj_in))
-            .execution_options(synchronize_session="fetch")
+            update(table)
+            .where(table.c.id == bindparam('b_id'))
+            .values({k: bindparam(f'b_{k}') for k in keys})
         )
         try:
-            await self.db_session.execute(q)
-            return await self.get(item_id)
+            await self.db_session.execute(q, [{f'b_{k}': v for k, v in it.items()} for it in values])
         except Exception as e:
             await self.db_session.rollback()  # noqa
             raise e
 
-    async def delete(self, item_id: UUID) -> None:
-        item = await self.get(item_id)
-        if not item:
+    async def delete(self, item_id: UUID) -> Any:
+        q = delete(self.model).where(self.model.id == item_id)
+        if (item := (await self.db_session.execute(self._returning_query(q))).scalar()) is None:
             raise error.ItemNotFound(model=self.model_name)
-        await self.db_session.delete(item)
-        await self.db_session.flush()  # noqa
+        return item
+
+    @staticmethod
+    def _get_lock_key(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big', signed=True)
+
+    async def advisory_xact_lock(self, key: str) -> None:
+        """
+        Wait for postgres advisory lock, it is released at the end of transaction
+        """
+        await self.db_session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': self._get_lock_key(key)})
+
+    async def advisory_xact_locks(self, keys: List[str]) -> None:
+        """
+        Wait for postgres advisory locks of all keys with a single query. Locks are taken in order of their
+        numeric keys, so callers that lock intersecting sets of keys can not deadlock
+        """
+        if keys:
+            q = text(
+                'SELECT pg_advisory_xact_lock(key) '
+                'FROM (SELECT DISTINCT unnest(CAST(:keys AS bigint[])) AS key ORDER BY key) AS lock_keys'
+            )
+            await self.db_session.execute(q, {'keys': [self._get_lock_key(key) for key in keys]})
+
+    async def try_advisory_xact_lock(self, key: str) -> bool:
+        q = text('SELECT pg_try_advisory_xact_lock(:key)')
+        return bool((await self.db_session.execute(q, {'key': self._get_lock_key(key)})).scalar())
+
+    async def try_advisory_locks(self, keys: List[str]) -> List[str]:
+        """
+        Try to take session level postgres advisory locks with a single query, they are held after commit
+        till advisory_unlock. Returns keys of taken locks
+        """
+        if not keys:
+            return []
+        lock_keys = {self._get_lock_key(key): key for key in keys}
+        q = text('SELECT key FROM unnest(CAST(:keys AS bigint[])) AS key WHERE pg_try_advisory_lock(key)')
+        return [lock_keys[it] for it in (await self.db_session.execute(q, {'keys': list(lock_keys)})).scalars()]
+
+    async def advisory_unlock(self, keys: List[str]) -> None:
+        if keys:
+            q = text('SELECT pg_advisory_unlock(key) FROM unnest(CAST(:keys AS bigint[])) AS key')
+            await self.db_session.execute(q, {'keys': [self._get_lock_key(key) for key in keys]})
+
+    async def advisory_unlock_all(self) -> None:
+        await self.db_session.execute(text('SELECT pg_advisory_unlock_all()'))
+
+    async def approximate_count(self) -> int:
+        """
+        Planner estimation of table rows amount, it is fast but updated only by VACUUM/ANALYZE
+        """
+        q = text('SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:table_name AS regclass)')
+        return max(0, (await self.db_session.execute(q, {'table_name': self.model.__tablename__})).scalar() or 0)
+
+    async def count_by_mode(self, count: schemas.PaginationCount, **kwargs) -> Optional[int]:
+        if count == schemas.PaginationCount.NONE:
+            return None
+        # estimation is available only for the whole table
+        if count == schemas.PaginationCount.APPROXIMATE and not kwargs:
+            return await self.approximate_count()
+        return await self.count(**kwargs)
+
+    async def get_all_after(
+            self,
+            cursor: Optional[tuple] = None,
+            limit: int = None,
+            query_modifiers: List[Callable] = None,
+            **kwargs
+    ) -> List:
+        """
+        Get items ordered by (created_at, id) keyset, that are placed after the cursor position
+        """
+        keyset = (self.model.created_at, self.model.id)
+        query_modifiers = [*(query_modifiers or []), lambda q: q.order_by(*keyset)]
+        if cursor is not None:
+            query_modifiers.append(lambda q: q.where(tuple_(*keyset) > tuple_(*cursor)))
+        return await self.get_all(offset=None, limit=limit, query_modifiers=query_modifiers, **kwargs)
 
     async def get_all_with_pagination(
         self,
@@ -147,20 +273,43 @@ class DefaultCRUD:
         offset: int = 0,
         limit: int = None,
         method: Callable = None,
+        count: schemas.PaginationCount = schemas.PaginationCount.EXACT,
         **kwargs
     ) -> schemas.PaginatedResponse:
         if not method:
             method = self.get_all
-        amount = await self.count(**kwargs)
+        amount = await self.count_by_mode(count, **kwargs)
         results = [
             wrapper_class(**jsonable_encoder(it)) for it in
             await method(offset=offset, limit=limit, *args, **kwargs)
         ]
         return schemas.PaginatedResponse(results=results, amount=amount)
 
-    async def _delete_by(self, **kwargs):
-        await self.db_session.execute(self._create_query_by(operator=delete, **kwargs))
-        await self.db_session.flush()  # noqa
+    async def get_all_with_cursor_pagination(
+        self,
+        wrapper_class: Type[BaseModel],
+        cursor: str = None,
+        limit: int = 10,
+        count: schemas.PaginationCount = schemas.PaginationCount.NONE,
+        **kwargs
+    ) -> schemas.PaginatedResponse:
+        items = await self.get_all_after(
+            cursor=schemas.decode_cursor(cursor) if cursor else None,
+            limit=limit + 1,
+            **kwargs
+        )
+        has_next = len(items) > limit
+        items = items[:limit]
+        next_cursor = schemas.encode_cursor(items[-1].created_at, items[-1].id) if has_next and items else None
+        return schemas.PaginatedResponse(
+            results=[wrapper_class(**jsonable_encoder(it)) for it in items],
+            next_cursor=next_cursor,
+            amount=await self.count_by_mode(count, **kwargs),
+        )
+
+    async def _delete_by(self, **kwargs) -> List:
+        q = self._create_query_by(operator=delete, **kwargs)
+        return (await self.db_session.execute(self._returning_query(q))).scalars().all()
 
     async def _get_or_create(self, **kwargs):
         if obj := await self.get_by(**kwargs):
@@ -1,11 +1,20 @@
 import os
+import uuid
+from datetime import datetime
+from typing import Optional
 from uuid import UUID
 
 from fastapi.encoders import jsonable_encoder
+from sqlalchemy import bindparam, func, or_, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
 
 from app import schemas
-from app.core import error, message, util
+from app.core import error, hash_algorithms, hasher, message, util
+from app.core.config import settings
+from app.core.phash_index import phash_index
+from app.core.staging import StagedFile
 from app.models import Image, Thumbnail
 
 from .common import DefaultCRUD
@@ -25,26 +34,136 @@ class ImageCRUD(DefaultCRUD):
                 model=self.model_name,
             )
 
-    async def create_and_write(
+    async def get_by_any_hash(self, hash_values: list[str]) -> Optional[Image]:
+        return (await self.db_session.execute(self._create_query_by(hash=hash_values, limit=1))).scalar()
+
+    async def get_by_file_digest(self, file_digest: str) -> Optional[Image]:
+        return (await self.db_session.execute(self._create_query_by(file_digest=file_digest, limit=1))).scalar()
+
+    async def get_phash_batch(
+            self,
+            cursor: Optional[tuple] = None,
+            limit: int = None,
+    ) -> list[tuple[UUID, int, datetime, datetime]]:
+        """
+        Get (id, phash, updated_at, created_at) of images with perceptual hash ordered by (created_at, id) keyset,
+        that are placed after the cursor position
+        """
+        keyset = (Image.created_at, Image.id)
+        q = select(Image.id, Image.phash, Image.updated_at, Image.created_at).where(Image.phash.isnot(None))
+        if cursor is not None:
+            q = q.where(tuple_(*keyset) > tuple_(*cursor))
+        return (await self.db_session.execute(q.order_by(*keyset).limit(limit))).all()
+
+    async def get_phash_updates(self, updated_after: datetime) -> list[tuple[UUID, Optional[int], datetime]]:
+        """
+        Get (id, phash, updated_at) of images updated after, phash is None for images which lost it
+        """
+        q = select(Image.id, Image.phash, Image.updated_at).where(Image.updated_at >= updated_after)
+        return (await self.db_session.execute(q)).all()
+
+    async def get_max_updated_at(self) -> Optional[datetime]:
+        return (await self.db_session.execute(select(func.max(Image.updated_at)))).scalar()
+
+    async def get_existing_ids(self, item_ids: list[UUID]) -> set[UUID]:
+        return set((await self.db_session.execute(select(Image.id).where(Image.id.in_(item_ids)))).scalars())
+
+    async def get_similar(
+            self,
+            phash: int,
+            max_distance: int,
+            limit: int = None,
+            exclude_id: UUID = None,
+    ) -> list[tuple[int, Image]]:
+        """
+        Find images with perceptual hash within Hamming distance, nearest first
+        """
+        if phash is None:
+            return []
+        item_ids = [item_id for _, item_id in phash_index.search(phash, max_distance) if item_id != exclude_id]
+        if not item_ids:
+            return []
+        # index may contain images deleted or rehashed since last sync, so distances are checked again with actual rows
+        items = [
+            (distance, item) for item in await self.get_all(id=item_ids)
+            if item.phash is not None and (distance := hasher.hamming_distance(phash, item.phash)) <= max_distance
+        ]
+        return sorted(items, key=lambda it: it[0])[:limit]
+
+    async def upsert_by_hash(
             self,
             original_filename: str,
             hash_value: str,
-            file_data,
+            file_digest: str = None,
+            phash: int = None,
+            size: int = None,
             name: str = None,
-    ) -> Image:
-        print('create_and_write')
+            hash_algorithm: str = None,
+            info: dict = None,
+    ) -> tuple[Image, bool]:
+        """
+        Create image or increment duplicate counter of existing one with the same hash in a single statement.
+        Info is intrinsic metadata from image_resizer.get_image_info.
+        Returns image and flag whether it was created
+        """
         file_type = util.get_file_type(original_filename)
         await self.raise_for_incorrect_format(original_filename)
-        item = await self._create(item=Image(
+        algorithm = hash_algorithms.get_algorithm(hash_algorithm or settings.HASH_ALGORITHM)
+        image_id = uuid.uuid4()
+        q = insert(Image).values(
+            id=image_id,
             original_filename=original_filename[-300:],
             file_type=file_type,
             hash=hash_value,
+            hash_algorithm=algorithm.name,
+            hash_version=algorithm.version,
+            file_digest=file_digest,
+            phash=phash,
+            size=size,
             name=name,
-        ))
-        filename = util.generate_image_filename(image_id=item.id, file_type=file_type)
-        util.save_image_to_storage(filename=filename, data=file_data)
-        item.size = os.path.getsize(util.get_image_path(item))
-        return item
+            **(info or {}),
+        )
+        q = q.on_conflict_do_update(
+            index_elements=[Image.hash],
+            set_={'duplicate_counter': Image.duplicate_counter + 1, 'updated_at': func.now()},
+        ).returning(*Image.__table__.columns)
+        item = (await self.db_session.execute(
+            select(Image).from_statement(q).execution_options(populate_existing=True)
+        )).scalar_one()
+        return item, item.id == image_id
+
+    async def create_and_write(
+            self,
+            original_filename: str,
+            hash_value: str,
+            staged_file: StagedFile,
+            phash: int = None,
+            name: str = None,
+            legacy_hashes: list[str] = None,
+            info: dict = None,
+    ) -> tuple[Image, bool]:
+        """
+        Legacy hashes are hashes of the same pixels by algorithms of not yet rehashed images.
+        Returns image and flag whether it was created
+        """
+        if legacy_hashes and (item := await self.get_by_any_hash([hash_value, *legacy_hashes])):
+            return await self.update_counter_by_step(image_id=item.id, step=1, **(
+                {} if item.hash == hash_value else self.get_rehash_values(hash_value)
+            )), False
+        item, created = await self.upsert_by_hash(
+            original_filename=original_filename,
+            hash_value=hash_value,
+            file_digest=staged_file.digest,
+            phash=phash,
+            size=staged_file.size,
+            name=name,
+            info=info,
+        )
+        if created:
+            filename = util.generate_image_filename(image_id=item.id, file_type=item.file_type)
+            util.move_image_to_storage(src_path=staged_file.path, filename=filename)
+            phash_index.add(item.phash, item.id)
+        return item, created
 
     async def create(
             self,
@@ -54,26 +173,32 @@ class ImageCRUD(DefaultCRUD):
     ) -> Image:
         file_type = util.get_file_type(original_filename)
         await self.raise_for_incorrect_format(original_filename)
-        return await self._create(item=Image(
+        return await self._create(values=dict(
             original_filename=original_filename[-300:],
             file_type=file_type,
             hash=hash_value,
             name=name,
         ))
 
-    async def update_counter_by_step(self, image_id: UUID, step: int):
-        try:
-            image = await self.get(image_id)
-            await self._update(item_id=image_id, obj_in={'duplicate_counter': image.duplicate_counter + step})
-        except Exception as e:
-            await self.db_session.rollback()
-            raise e
+    @staticmethod
+    def get_rehash_values(hash_value: str, hash_algorithm: str = None) -> dict:
+        algorithm = hash_algorithms.get_algorithm(hash_algorithm or settings.HASH_ALGORITHM)
+        return {'hash': hash_value, 'hash_algorithm': algorithm.name, 'hash_version': algorithm.version}
+
+    async def update_counter_by_step(self, image_id: UUID, step: int, **values) -> Image:
+        return await self._update(
+            item_id=image_id,
+            obj_in={'duplicate_counter': Image.duplicate_counter + step, **values},
+        )
+
+    async def increment_counter(self, image_id: UUID) -> Image:
+        return await self.update_counter_by_step(image_id=image_id, step=1)
 
-    async def increment_counter(self, image_id: UUID):
-        await self.update_counter_by_step(image_id=image_id, step=1)
+    async def decrement_counter(self, image_id: UUID) -> Image:
+        return await self.update_counter_by_step(image_id=image_id, step=-1)
 
-    async def decrement_counter(self, image_id: UUID):
-        await self.update_counter_by_step(image_id=image_id, step=-1)
+    async def update_many(self, values: list[dict]) -> None:
+        await self._update_many(values)
 
     async def update(self, image_id: UUID, obj_in: schemas.ImageUpdate) -> Image:
         if await self.has_by(name=obj_in.name):
@@ -86,15 +211,11 @@ class ImageCRUD(DefaultCRUD):
             os.remove(path)
 
     async def delete_with_content(self, item_id: UUID):
-        item = await self.get(item_id)
-        await self.delete_content(item)
-        await self.delete(item_id)
+        await self.delete_content(await self.delete(item_id))
 
     async def delete_by_with_content(self, **kwargs):
-        items = await self.get_all(**kwargs)
-        for item in items:
+        for item in await self._delete_by(**kwargs):
             await self.delete_content(item)
-        await self._delete_by(**kwargs)
 
 
 class ThumbnailCRUD(DefaultCRUD):
@@ -109,7 +230,7 @@ class ThumbnailCRUD(DefaultCRUD):
             file_type: str,
             file_data: bytes,
     ) -> Thumbnail:
-        item = await self._create(item=Thumbnail(
+        item = await self._create(values=dict(
             image_id=image.id,
             width=width,
             height=height,
@@ -126,26 +247,108 @@ class ThumbnailCRUD(DefaultCRUD):
             width: int,
             height: int,
             file_type: str,
+            size: int = None,
+            quality: int = 0,
     ) -> Thumbnail:
-        return await self._create(item=Thumbnail(
+        return await self._create(values=dict(
             image_id=image.id,
             width=width,
             height=height,
             file_type=file_type,
+            size=size,
+            quality=quality,
         ))
 
+    async def add_hits(self, hits: dict[UUID, tuple[int, datetime]]) -> None:
+        """
+        Add accumulated hits amount and set last access time for thumbnails with executemany
+        """
+        if not hits:
+            return
+        table = Thumbnail.__table__
+        q = (
+            update(table)
+            .where(table.c.id == bindparam('b_id'))
+            .values(hits=table.c.hits + bindparam('b_hits'), last_accessed_at=bindparam('b_last_accessed_at'))
+        )
+        await self.db_session.execute(q, [
+            {'b_id': item_id, 'b_hits': amount, 'b_last_accessed_at': accessed_at}
+            for item_id, (amount, accessed_at) in hits.items()
+        ])
+
+    async def get_total_size(self) -> int:
+        return (await self.db_session.execute(select(func.coalesce(func.sum(Thumbnail.size), 0)))).scalar_one()
+
+    async def get_eviction_candidates(self, policy: str, offset: int = 0, limit: int = None) -> list[Thumbnail]:
+        """
+        Get thumbnails ordered from the least valuable by LRU or LFU policy
+        """
+        order = (Thumbnail.last_accessed_at,) if policy == 'lru' else (Thumbnail.hits, Thumbnail.last_accessed_at)
+        return await self.get_all(offset=offset, limit=limit, query_modifiers=[lambda q: q.order_by(*order)])
+
+    async def create_many(self, values: list[dict]) -> list[Thumbnail]:
+        """
+        Create thumbnails with a single statement, already existing sizes are skipped
+        """
+        return await self._create_many(values, on_conflict_do_nothing=True)
+
+    async def get_smallest_covering(
+            self,
+            image_id: UUID,
+            width: int,
+            height: int,
+            file_type: str,
+    ) -> Optional[Thumbnail]:
+        """
+        Get the smallest thumbnail of encoder default quality that is at least width x height,
+        but not exactly of that size
+        """
+        q = self._create_query_by(
+            image_id=image_id,
+            file_type=file_type,
+            quality=0,
+            query_modifiers=[
+                lambda q: q.where(Thumbnail.width >= width, Thumbnail.height >= height),
+                lambda q: q.where(or_(Thumbnail.width != width, Thumbnail.height != height)),
+                lambda q: q.order_by(Thumbnail.width * Thumbnail.height),
+            ],
+            limit=1,
+        )
+        return (await self.db_session.execute(q)).scalar()
+
+    async def update_size(self, thumbnail_id: UUID, size: int) -> Thumbnail:
+        return await self._update(item_id=thumbnail_id, obj_in={'size': size})
+
+    async def update_sizes(self, sizes: dict[UUID, int]) -> None:
+        await self._update_many([{'id': thumbnail_id, 'size': size} for thumbnail_id, size in sizes.items()])
+
+    async def get_by_size(
+            self,
+            image_id: UUID,
+            width: int,
+            height: int,
+            file_type: str,
+            quality: int = 0,
+    ) -> Optional[Thumbnail]:
+        q = self._create_query_by(
+            image_id=image_id, width=width, height=height, file_type=file_type, quality=quality, limit=1
+        )
+        return (await self.db_session.execute(q)).scalar()
+
+    async def delete_by(self, **kwargs) -> list[Thumbnail]:
+        """
+        Delete rows without their files, files need to be removed by delete_content
+        """
+        return await self._delete_by(**kwargs)
+
     @staticmethod
     async def delete_content(item: Thumbnail) -> None:
         if (path := util.get_thumbnail_path(item)) and os.path.exists(path):
             os.remove(path)
 
     async def delete_with_content(self, item_id: UUID) -> None:
-        item = await self.get(item_id)
-        await self.delete_content(item)
-        await self.delete(item_id)
+        await self.delete_content(await self.delete(item_id))
 
     async def delete_by_with_content(self, **kwargs) -> None:
-        items = await self.get_all(**kwargs)
-        for item in items:
+        for item in await self._delete_by(**kwargs):
             await self.delete_content(item)
-        await self._delete_by(**kwargs)
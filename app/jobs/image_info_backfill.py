@@ -0,0 +1,45 @@
+"""
+Fill intrinsic metadata (dimensions, mode, channels, frames, decoded size) for images stored before
+it was extracted at ingest
+
+Usage: python -m app.jobs.image_info_backfill
+"""
+import asyncio
+import os
+from typing import Optional
+
+from app.core import image_resizer, util
+from app.core.executor import cpu_executor
+from app.crud import ImageCRUD
+from app.db.session import async_session
+
+
+async def get_image_info(path: str) -> Optional[dict]:
+    if not os.path.exists(path):
+        return None
+    try:
+        return await cpu_executor.run(image_resizer.get_image_info, path)
+    except (OSError, ValueError):
+        return None
+
+
+async def backfill_image_info() -> int:
+    updated = 0
+    cursor = None
+    async with async_session() as session:
+        image_crud = ImageCRUD(session)
+        while images := await image_crud.get_all_after(cursor=cursor, limit=cpu_executor.capacity, width=None):
+            cursor = (images[-1].created_at, images[-1].id)
+            infos = await asyncio.gather(*(get_image_info(util.get_image_path(image)) for image in images))
+            values = [{'id': image.id, **info} for image, info in zip(images, infos) if info is not None]
+            await image_crud.update_many(values)
+            await session.commit()
+            updated += len(values)
+    return updated
+
+
+if __name__ == '__main__':
+    try:
+        print(f'Updated images: {asyncio.run(backfill_image_info())}')
+    finally:
+        cpu_executor.shutdown()
@@ -0,0 +1,43 @@
+"""
+Fill perceptual hash for images stored before it was computed at ingest
+
+Usage: python -m app.jobs.phash_backfill
+"""
+import asyncio
+import os
+
+from app.core import hasher, util
+from app.core.executor import cpu_executor
+from app.crud import ImageCRUD
+from app.db.session import async_session
+
+
+async def get_phash(path: str):
+    if not os.path.exists(path):
+        return None
+    try:
+        return await cpu_executor.run(hasher.get_image_file_perceptual_hash, path)
+    except ValueError:
+        return None
+
+
+async def backfill_phash() -> int:
+    updated = 0
+    cursor = None
+    async with async_session() as session:
+        image_crud = ImageCRUD(session)
+        while images := await image_crud.get_all_after(cursor=cursor, limit=cpu_executor.capacity, phash=None):
+            cursor = (images[-1].created_at, images[-1].id)
+            phashes = await asyncio.gather(*(get_phash(util.get_image_path(image)) for image in images))
+            values = [{'id': image.id, 'phash': phash} for image, phash in zip(images, phashes) if phash is not None]
+            await image_crud.update_many(values)
+            await session.commit()
+            updated += len(values)
+    return updated
+
+
+if __name__ == '__main__':
+    try:
+        print(f'Updated images: {asyncio.run(backfill_phash())}')
+    finally:
+        cpu_executor.shutdown()
@@ -0,0 +1,60 @@
+"""
+Rehash stored images with HASH_ALGORITHM without downtime:
+1. Set HASH_ALGORITHM to the new algorithm and add the previous one to HASH_LEGACY_ALGORITHMS,
+   so uploads are still deduplicated against not yet rehashed images
+2. Run `python -m app.jobs.rehash`
+3. Remove the previous algorithm from HASH_LEGACY_ALGORITHMS
+
+Usage: python -m app.jobs.rehash
+"""
+import asyncio
+import os
+
+from sqlalchemy import and_, not_
+
+from app.core import hash_algorithms, hasher, util
+from app.core.config import settings
+from app.core.executor import cpu_executor
+from app.crud import ImageCRUD
+from app.db.session import async_session
+from app.models import Image
+
+
+async def get_hash(path: str):
+    if not os.path.exists(path):
+        return None
+    try:
+        return await cpu_executor.run(hasher.get_image_file_hash, path, settings.HASH_ALGORITHM)
+    except ValueError:
+        return None
+
+
+async def rehash() -> int:
+    algorithm = hash_algorithms.get_algorithm(settings.HASH_ALGORITHM)
+    is_outdated = not_(and_(Image.hash_algorithm == algorithm.name, Image.hash_version == algorithm.version))
+    updated = 0
+    cursor = None
+    async with async_session() as session:
+        image_crud = ImageCRUD(session)
+        while images := await image_crud.get_all_after(
+                cursor=cursor,
+                limit=cpu_executor.capacity,
+                query_modifiers=[lambda q: q.where(is_outdated)],
+        ):
+            cursor = (images[-1].created_at, images[-1].id)
+            hashes = await asyncio.gather(*(get_hash(util.get_image_path(image)) for image in images))
+            values = [
+                {'id': image.id, **image_crud.get_rehash_values(hash_value)}
+                for image, hash_value in zip(images, hashes) if hash_value is not None
+            ]
+            await image_crud.update_many(values)
+            await session.commit()
+            updated += len(values)
+    return updated
+
+
+if __name__ == '__main__':
+    try:
+        print(f'Rehashed images: {asyncio.run(rehash())}')
+    finally:
+        cpu_executor.shutdown()
@@ -10,6 +10,10 @@ from starlette.middleware.cors import CORSMiddleware
 from app.api.api import api_router
 from app.core import error, message
 from app.core.config import settings
+from app.core.executor import cpu_executor
+from app.services.comparison import comparison_service
+from app.services.phash_index import phash_index_service
+from app.services.thumbnail import thumbnail_service
 
 # automatic run migrations at start, useful for docker
 if settings.AUTORUN_MIGRATIONS and (rc := os.system('python -m alembic upgrade head') != 0):
@@ -41,6 +45,20 @@ async def startup():
         os.makedirs(settings.STORAGE_DIR)
     if not os.path.exists(settings.THUMBNAILS_DIR):
         os.makedirs(settings.THUMBNAILS_DIR)
+    if not os.path.exists(settings.STAGING_DIR):
+        os.makedirs(settings.STAGING_DIR)
+    cpu_executor.start()
+    thumbnail_service.start()
+    comparison_service.start()
+    await phash_index_service.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    phash_index_service.stop()
+    comparison_service.stop()
+    await thumbnail_service.stop()
+    cpu_executor.shutdown()
 
 
 def handle_default_error(exc: Exception, status_code: int, headers: dict = None) -> JSONResponse:
@@ -91,6 +109,11 @@ async def save_exception_handler(request: Request, exc: Exception) -> JSONRespon
     return handle_default_error(exc, status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+@app.exception_handler(error.ExecutorOverloaded)
+async def executor_overloaded_handler(request: Request, exc: Exception) -> JSONResponse:  # noqa
+    return handle_default_error(exc, status.HTTP_503_SERVICE_UNAVAILABLE, headers={'Retry-After': '1'})
+
+
 @app.exception_handler(FileNotFoundError)
 async def save_exception_handler(request: Request, exc: Exception) -> JSONResponse:  # noqa
     return handle_default_error(message.ERROR_FILE_NOT_FOUND, status.HTTP_500_INTERNAL_SERVER_ERROR)
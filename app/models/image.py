@@ -1,6 +1,8 @@
 import uuid
+from typing import Optional
 
-from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy import (BigInteger, Column, DateTime, ForeignKey, Index,
+                        Integer, String, func)
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.orm import relationship
 
@@ -8,25 +10,54 @@ from .util import TimeStamped
 
 
 class Image(TimeStamped):
+    __table_args__ = (
+        Index('ix_image_created_at_id', 'created_at', 'id'),
+        Index('ix_image_updated_at', 'updated_at'),
+    )
+
     id = Column(UUID(as_uuid=True), primary_key=True, index=True, default=uuid.uuid4)
     original_filename = Column(String(300), unique=False)
     file_type = Column(String(50), unique=False)
     name = Column(String(300), unique=True, nullable=True)
     hash = Column(String(512), unique=True, index=True)
+    hash_algorithm = Column(String(32), default='md5', server_default='md5', nullable=False)
+    hash_version = Column(Integer, default=1, server_default='1', nullable=False)
+    file_digest = Column(String(128), index=True)
+    phash = Column(BigInteger, index=True)
     size = Column(Integer)
+    width = Column(Integer)
+    height = Column(Integer)
+    mode = Column(String(16))
+    channels = Column(Integer)
+    frames = Column(Integer)
+    decoded_size = Column(BigInteger)
     duplicate_counter = Column(Integer, default=1, server_default="1", nullable=False)
     thumbnails = relationship('Thumbnail', back_populates='image', cascade="delete")
 
+    @property
+    def dimensions(self) -> Optional[tuple[int, int]]:
+        return (self.width, self.height) if self.width and self.height else None
+
     def __repr__(self):
         return '<Image %r, %r, %r, %r>' % (self.id, self.hash, self.original_filename, self.duplicate_counter)
 
 
 class Thumbnail(TimeStamped):
+    __table_args__ = (
+        Index('ix_thumbnail_image_id_created_at_id', 'image_id', 'created_at', 'id'),
+        Index('ix_thumbnail_image_id_size', 'image_id', 'width', 'height', 'file_type', 'quality', unique=True),
+        Index('ix_thumbnail_hits_last_accessed_at', 'hits', 'last_accessed_at'),
+    )
+
     id = Column(UUID(as_uuid=True), primary_key=True, index=True, default=uuid.uuid4)
     file_type = Column(String(50), unique=False)
     width = Column(Integer)
     height = Column(Integer)
     size = Column(Integer)
+    # encoder quality of lossy rendition, 0 is for encoder defaults
+    quality = Column(Integer, default=0, server_default='0', nullable=False)
+    hits = Column(Integer, default=0, server_default='0', nullable=False)
+    last_accessed_at = Column(DateTime, default=func.now(), index=True)
     image_id = Column(UUID(as_uuid=True), ForeignKey("image.id"), nullable=False, index=True)
     image = relationship('Image', back_populates='thumbnails')
 
@@ -1,4 +1,9 @@
-from .image import (Image, ImageCompareStatus, ImageFormats, ImageUpdate,
-                    Thumbnail, ThumbnailCreate)
-from .pagination import PaginatedResponse, PaginationData, paginate_response
+from .image import (Image, ImageBatchCompare, ImageCompareMetrics,
+                    ImageCompareStatus, ImageFormats, ImagePairCompare,
+                    ImagesThumbnailBatchCreate, ImageUpdate, RenditionFormats,
+                    SimilarImage, Thumbnail, ThumbnailBatchCreate,
+                    ThumbnailCreate)
+from .pagination import (PaginatedResponse, PaginationCount, PaginationData,
+                         PaginationMode, decode_cursor, encode_cursor,
+                         paginate_response)
 from .util import TimeStamped, ValuesEnum, is_valid_uuid
@@ -1,7 +1,7 @@
-from typing import Optional
+from typing import List, Optional
 from uuid import UUID
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 from .util import TimeStamped, ValuesEnum
 
@@ -12,10 +12,25 @@ class Image(TimeStamped):
     file_type: str
     name: Optional[str]
     hash: str
+    hash_algorithm: str
+    hash_version: int
+    file_digest: Optional[str]
+    phash: Optional[int]
     size: Optional[int]
+    width: Optional[int]
+    height: Optional[int]
+    mode: Optional[str]
+    channels: Optional[int]
+    frames: Optional[int]
+    decoded_size: Optional[int]
     duplicate_counter: int
 
 
+class SimilarImage(BaseModel):
+    image: Image
+    distance: int
+
+
 class ImageUpdate(BaseModel):
     name: str
 
@@ -24,10 +39,36 @@ class ImageCompareStatus(BaseModel):
     equal: bool
 
 
+class ImageCompareMetrics(BaseModel):
+    ssim: float
+    # null when images are identical and PSNR is infinite
+    psnr: Optional[float]
+    mean_abs_error: float
+    max_abs_error: int
+
+
+class ImageBatchCompare(BaseModel):
+    # without reference all pairs of images are compared
+    reference_id: Optional[UUID]
+    image_ids: List[UUID] = Field(..., min_items=1, max_items=200)
+    tolerance: int = Field(0, ge=0, le=255)
+    metrics: bool = False
+    max_side: Optional[int] = Field(None, ge=8, le=10000)
+
+
+class ImagePairCompare(BaseModel):
+    image_id: UUID
+    image2_id: UUID
+    equal: bool
+    metrics: Optional[ImageCompareMetrics]
+
+
 class Thumbnail(TimeStamped):
     id: UUID
     width: int
     height: int
+    file_type: Optional[str]
+    quality: int
     image_id: UUID
 
 
@@ -37,8 +78,24 @@ class ThumbnailCreate(BaseModel):
     height: Optional[int]
 
 
+class ThumbnailBatchCreate(BaseModel):
+    sizes: List[ThumbnailCreate] = Field(..., min_items=1, max_items=32)
+
+
+class ImagesThumbnailBatchCreate(ThumbnailBatchCreate):
+    image_ids: List[UUID] = Field(..., min_items=1, max_items=100)
+
+
 class ImageFormats(ValuesEnum):
     JPG = 'jpg'
     JPEG = 'jpeg'
     PNG = 'png'
     WEBP = 'webp'
+
+
+class RenditionFormats(ValuesEnum):
+    AVIF = 'avif'
+    WEBP = 'webp'
+    JPEG = 'jpeg'
+    JPG = 'jpg'
+    PNG = 'png'
@@ -1,21 +1,42 @@
+import base64
+from datetime import datetime
 from typing import List, Optional
+from uuid import UUID
 
 from fastapi import Request
 from pydantic import AnyHttpUrl, BaseModel, validator
 from starlette.datastructures import URL
 
+from .util import ValuesEnum
+
+
+class PaginationMode(ValuesEnum):
+    OFFSET = 'offset'
+    CURSOR = 'cursor'
+
+
+class PaginationCount(ValuesEnum):
+    EXACT = 'exact'
+    APPROXIMATE = 'approximate'
+    NONE = 'none'
+
 
 class PaginatedResponse(BaseModel):
     results: List
     next: Optional[AnyHttpUrl]
     previous: Optional[AnyHttpUrl]
-    amount: int
+    next_cursor: Optional[str]
+    amount: Optional[int]
 
 
 class PaginationData(BaseModel):
     request: Request
     limit: int = 10
     offset: int = 0
+    mode: PaginationMode = PaginationMode.OFFSET
+    cursor: Optional[str] = None
+    # exact for offset mode and none for cursor mode if it is not passed
+    count: Optional[PaginationCount] = None
 
     @classmethod
     def _raise_for_negative(cls, v, field):
@@ -32,21 +53,66 @@ class PaginationData(BaseModel):
         PaginationData._raise_for_negative(v, 'offset')
         return v
 
+    @validator("cursor")
+    def validate_cursor(cls, v):
+        if v:
+            decode_cursor(v)
+        return v
+
+    @validator("count", always=True)
+    def default_count(cls, v, values):
+        if v is not None:
+            return v
+        # cursor pages cost O(page size), so total is not counted unless it is requested
+        is_cursor_mode = values.get('mode') == PaginationMode.CURSOR or values.get('cursor') is not None
+        return PaginationCount.NONE if is_cursor_mode else PaginationCount.EXACT
+
+    @property
+    def is_cursor_mode(self) -> bool:
+        return self.mode == PaginationMode.CURSOR or self.cursor is not None
+
     class Config:
         arbitrary_types_allowed = True
 
 
+def encode_cursor(created_at: datetime, item_id: UUID) -> str:
+    """
+    Make opaque cursor pointing to the (created_at, id) keyset position
+    """
+    return base64.urlsafe_b64encode(f'{created_at.isoformat()}|{item_id}'.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, UUID]:
+    try:
+        created_at, item_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), UUID(item_id)
+    except Exception:
+        raise ValueError('cursor is invalid')
+
+
 async def paginate_response(
         paginated_response: PaginatedResponse,
         paginator: PaginationData
 ) -> PaginatedResponse:
     url = URL(str(paginator.request.url))
+    if paginator.is_cursor_mode:
+        paginated_response.next = str(url.replace_query_params(
+            limit=paginator.limit,
+            cursor=paginated_response.next_cursor,
+            count=paginator.count.value,
+        )) if paginated_response.next_cursor else None
+        return paginated_response
     paginated_response.previous = str(url.replace_query_params(
         limit=paginator.limit,
         offset=paginator.offset - paginator.limit
     )) if paginator.offset >= paginator.limit else None
+    offset = paginator.offset + paginator.limit
+    has_next = (
+        offset < paginated_response.amount if paginated_response.amount is not None
+        else len(paginated_response.results) >= paginator.limit
+    )
     paginated_response.next = str(url.replace_query_params(
         limit=paginator.limit,
         offset=offset
-    )) if (offset := paginator.offset + paginator.limit) < paginated_response.amount else None
+    )) if has_next else None
     return paginated_response
@@ -0,0 +1,343 @@
+"""
+Images comparison that answers from stored rows where it is possible.
+
+Exact pixels hash is unique, so two different images hashed by the same algorithm version are never pixel-equal,
+and images of different dimensions are never equal with any tolerance. Only the rest is decoded on CPU executor,
+those results are kept in per-worker LRU cache by unordered images pair, stored images content never changes.
+
+Diff images are cached on disk by pair of images hashes when DIFF_CACHE_DIR is set,
+the least recently used ones are evicted over DIFF_CACHE_MAX_BYTES
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import uuid
+from collections import OrderedDict
+from dataclasses import asdict
+from typing import Optional
+
+from starlette.concurrency import run_in_threadpool
+
+from app.core import image_comparator, image_resizer, metrics, util
+from app.core.config import settings
+from app.core.executor import cpu_executor
+from app.crud import ThumbnailCRUD
+from app.models import Image, Thumbnail
+
+
+def get_pair_key(image_id: uuid.UUID, image2_id: uuid.UUID, tolerance: int) -> tuple[uuid.UUID, uuid.UUID, int]:
+    return (*sorted((image_id, image2_id)), tolerance)
+
+
+def get_diff_cache_path(image: Image, image2: Image, tolerance: int) -> str:
+    # diff mask is symmetric, so both orders of images share the same file
+    key = hashlib.sha256('|'.join([*sorted((image.hash, image2.hash)), str(tolerance)]).encode()).hexdigest()
+    return os.path.join(settings.DIFF_CACHE_DIR, key[:2], f'{key}.jpg')
+
+
+def read_cached_diff_stats(path: str) -> Optional[image_comparator.DiffStats]:
+    try:
+        with open(f'{path}.json') as f:
+            values = json.load(f)
+        stats = image_comparator.DiffStats(**{**values, 'bbox': tuple(values['bbox']) if values['bbox'] else None})
+        # access time is tracked by mtime for eviction, atime is often disabled on mounts
+        os.utime(path)
+    except (OSError, ValueError, TypeError, KeyError):
+        return None
+    return stats
+
+
+def read_cached_diff(path: str) -> Optional[tuple[bytes, image_comparator.DiffStats]]:
+    if (stats := read_cached_diff_stats(path)) is None:
+        return None
+    try:
+        with open(path, 'rb') as f:
+            return f.read(), stats
+    except OSError:
+        return None
+
+
+def write_cached_diff(path: str, data: bytes, stats: image_comparator.DiffStats) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = os.path.join(os.path.dirname(path), f'.tmp-{uuid.uuid4()}')
+    try:
+        with open(f'{temp_path}.json', 'w') as f:
+            json.dump(asdict(stats), f)
+        os.replace(f'{temp_path}.json', f'{path}.json')
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    finally:
+        for it in (temp_path, f'{temp_path}.json'):
+            if os.path.exists(it):
+                os.remove(it)
+
+
+def evict_cached_diffs(cache_dir: str, max_bytes: int) -> int:
+    """
+    Remove the least recently used diff images while cache dir is over max_bytes. Returns amount of freed bytes
+    """
+    entries = []
+    total = 0
+    for root, _, filenames in os.walk(cache_dir):
+        for filename in filenames:
+            if filename.endswith('.jpg'):
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+    freed = 0
+    for _, size, path in sorted(entries):
+        if total - freed <= max_bytes:
+            break
+        for it in (path, f'{path}.json'):
+            if os.path.exists(it):
+                os.remove(it)
+        freed += size
+    return freed
+
+
+class ComparisonService:
+    def __init__(self, cache_size: int):
+        self.cache_size = cache_size
+        self._cache: OrderedDict[tuple, bool] = OrderedDict()
+        self._fast_path = metrics.counter('compare.fast_path')
+        self._cache_hits = metrics.counter('compare.cache_hits')
+        self._cache_misses = metrics.counter('compare.cache_misses')
+        self._diff_cache_hits = metrics.counter('compare.diff_cache_hits')
+        self._diff_cache_misses = metrics.counter('compare.diff_cache_misses')
+        self._diff_evicted_bytes = metrics.counter('compare.diff_evicted_bytes')
+        self._tasks: list[asyncio.Task] = []
+
+    @staticmethod
+    def get_stored_result(image: Image, image2: Image, tolerance: int = 0) -> Optional[bool]:
+        """
+        Comparison result by stored hash and metadata, None if pixels need to be compared
+        """
+        if image.id == image2.id:
+            return True
+        if image.dimensions and image2.dimensions and image.dimensions != image2.dimensions:
+            return False
+        if not tolerance and (image.hash_algorithm, image.hash_version) == (image2.hash_algorithm, image2.hash_version):
+            return image.hash == image2.hash
+        return None
+
+    def _cache_result(self, key: tuple, result: bool) -> None:
+        self._cache[key] = result
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _get_known_result(self, image: Image, image2: Image, tolerance: int = 0) -> Optional[bool]:
+        if (result := self.get_stored_result(image, image2, tolerance)) is not None:
+            self._fast_path.inc()
+            return result
+        key = get_pair_key(image.id, image2.id, tolerance)
+        if (result := self._cache.get(key)) is not None:
+            self._cache_hits.inc()
+            self._cache.move_to_end(key)
+            return result
+        self._cache_misses.inc()
+        return None
+
+    async def are_equal(self, image: Image, image2: Image, tolerance: int = 0) -> bool:
+        if (result := self._get_known_result(image, image2, tolerance)) is not None:
+            return result
+        key = get_pair_key(image.id, image2.id, tolerance)
+        result = await cpu_executor.run(
+            image_comparator.are_images_equal,
+            util.get_image_path(image),
+            util.get_image_path(image2),
+            tolerance,
+        )
+        if self.cache_size:
+            self._cache_result(key, result)
+        return result
+
+    @staticmethod
+    async def _get_decoded_size(images: list[Image], with_metrics: bool = False, max_side: int = None) -> int:
+        """
+        Memory of batch comparison pixels, sizes and modes are read from files headers for rows without stored info
+        """
+        known = [it for it in images if it.width and it.height and it.mode]
+        unknown = [it for it in images if not (it.width and it.height and it.mode)]
+        infos = await asyncio.gather(*(
+            run_in_threadpool(image_resizer.get_image_info, util.get_image_path(it)) for it in unknown
+        ))
+        sizes = [(it.width, it.height, it.mode) for it in known]
+        sizes.extend((it['width'], it['height'], it['mode']) for it in infos)
+        return image_comparator.get_decoded_size(sizes, with_metrics, max_side)
+
+    async def compare_many(
+            self,
+            pairs: list[tuple[Image, Image]],
+            tolerance: int = 0,
+            with_metrics: bool = False,
+            max_side: int = None,
+    ) -> list[tuple[bool, Optional[image_comparator.CompareMetrics]]]:
+        """
+        Equality and optionally metrics of every pair. Pairs that can not be answered from stored rows and cache
+        are compared by one executor task that decodes each of their images once
+        """
+        results = [None] * len(pairs)
+        pending = []
+        for index, (image, image2) in enumerate(pairs):
+            equal = self._get_known_result(image, image2, tolerance)
+            if image.id == image2.id:
+                results[index] = (True, image_comparator.IDENTICAL_METRICS if with_metrics else None)
+            elif equal is not None and not (with_metrics and image.dimensions == image2.dimensions):
+                results[index] = (equal, None)
+            else:
+                pending.append(index)
+        if not pending:
+            return results
+        images = {it.id: it for index in pending for it in pairs[index]}
+        decoded_size = await self._get_decoded_size(list(images.values()), with_metrics, max_side)
+        if decoded_size > settings.COMPARE_BATCH_MAX_BYTES:
+            raise ValueError('decoded images of comparison batch are too big, split it into smaller batches')
+        positions = {image_id: position for position, image_id in enumerate(images)}
+        compared = await cpu_executor.run(
+            image_comparator.compare_many,
+            [util.get_image_path(it) for it in images.values()],
+            [(positions[pairs[index][0].id], positions[pairs[index][1].id]) for index in pending],
+            tolerance,
+            with_metrics,
+            max_side,
+            cpu_executor.threads_per_task,
+        )
+        for index, result in zip(pending, compared):
+            results[index] = result
+            if self.cache_size:
+                self._cache_result(get_pair_key(pairs[index][0].id, pairs[index][1].id, tolerance), result[0])
+        return results
+
+    async def get_diff_image(
+            self,
+            image: Image,
+            image2: Image,
+            tolerance: int = 0,
+    ) -> tuple[bytes, image_comparator.DiffStats]:
+        """
+        JPEG of diff mask with its statistics, from disk cache if it is enabled
+        """
+        path = get_diff_cache_path(image, image2, tolerance) if settings.DIFF_CACHE_DIR else None
+        if path and (cached := await run_in_threadpool(read_cached_diff, path)) is not None:
+            self._diff_cache_hits.inc()
+            return cached
+        self._diff_cache_misses.inc()
+        data, stats = await cpu_executor.run(
+            image_comparator.get_compare_image,
+            util.get_image_path(image),
+            util.get_image_path(image2),
+            tolerance,
+        )
+        if path:
+            try:
+                await run_in_threadpool(write_cached_diff, path, data, stats)
+            except OSError:
+                logging.exception('Diff image caching failed')
+        return data, stats
+
+    async def get_diff_file(
+            self,
+            image: Image,
+            image2: Image,
+            tolerance: int = 0,
+    ) -> tuple[Optional[str], Optional[bytes], image_comparator.DiffStats]:
+        """
+        Path of cached diff image with its statistics, so file can be sent without reading it.
+        If diff cache is disabled or diff image could not be cached, computed data is returned instead of path
+        """
+        path = get_diff_cache_path(image, image2, tolerance) if settings.DIFF_CACHE_DIR else None
+        if path and (stats := await run_in_threadpool(read_cached_diff_stats, path)) is not None:
+            self._diff_cache_hits.inc()
+            return path, None, stats
+        data, stats = await self.get_diff_image(image, image2, tolerance)
+        if path and os.path.exists(path):
+            return path, None, stats
+        return None, data, stats
+
+    @staticmethod
+    async def _get_working_thumbnail(
+            thumbnail_crud: ThumbnailCRUD,
+            image: Image,
+            size: tuple[int, int],
+    ) -> Optional[Thumbnail]:
+        """
+        Thumbnail of working copy size or the smallest one that covers it, None if there is no such with a file
+        """
+        thumbnail = await thumbnail_crud.get_by_size(image.id, *size, image.file_type)
+        if thumbnail is None:
+            thumbnail = await thumbnail_crud.get_smallest_covering(image.id, *size, image.file_type)
+        if thumbnail is not None and os.path.exists(util.get_thumbnail_path(thumbnail)):
+            return thumbnail
+        return None
+
+    async def get_metrics(
+            self,
+            image: Image,
+            image2: Image,
+            max_side: int = None,
+            thumbnail_crud: ThumbnailCRUD = None,
+    ) -> image_comparator.CompareMetrics:
+        """
+        SSIM, PSNR and absolute errors of working copies downscaled to fit max_side, cached thumbnails are decoded
+        instead of originals when image dimensions are stored and both images have thumbnails of the same size
+        """
+        if image.id == image2.id:
+            self._fast_path.inc()
+            return image_comparator.IDENTICAL_METRICS
+        if image.dimensions and image2.dimensions and image.dimensions != image2.dimensions:
+            raise ValueError('images sizes are different')
+        # size is checked by comparator after decoding, when dimensions of any image are not stored
+        original_size = image.dimensions if image.dimensions and image2.dimensions else None
+        originals = [util.get_image_path(image), util.get_image_path(image2)]
+        sources = originals
+        if original_size and thumbnail_crud is not None and max_side:
+            size = image_comparator.get_working_size(original_size, max_side)
+            if size != original_size:
+                thumbnails = [await self._get_working_thumbnail(thumbnail_crud, it, size) for it in (image, image2)]
+                # both working copies need to pass the same pipeline, otherwise its artefacts are measured
+                if all(thumbnails) and len({(it.width, it.height, it.quality) for it in thumbnails}) == 1:
+                    sources = [util.get_thumbnail_path(it) for it in thumbnails]
+        try:
+            return await cpu_executor.run(
+                image_comparator.get_compare_metrics, *sources, original_size, max_side
+            )
+        except FileNotFoundError as e:
+            # thumbnail could be evicted after it was chosen
+            if sources == originals:
+                raise e
+            return await cpu_executor.run(
+                image_comparator.get_compare_metrics, *originals, original_size, max_side
+            )
+
+    async def evict_diff_images(self) -> None:
+        self._diff_evicted_bytes.inc(await run_in_threadpool(
+            evict_cached_diffs, settings.DIFF_CACHE_DIR, settings.DIFF_CACHE_MAX_BYTES
+        ))
+
+    async def _run_evictor(self) -> None:
+        while True:
+            await asyncio.sleep(settings.DIFF_CACHE_EVICTION_INTERVAL)
+            try:
+                await self.evict_diff_images()
+            except Exception:
+                logging.exception('Diff images eviction failed')
+
+    def start(self) -> None:
+        if settings.DIFF_CACHE_DIR and settings.DIFF_CACHE_MAX_BYTES:
+            self._tasks = [asyncio.create_task(self._run_evictor())]
+
+    def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+
+comparison_service = ComparisonService(cache_size=settings.COMPARE_CACHE_SIZE)
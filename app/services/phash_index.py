@@ -0,0 +1,74 @@
+"""
+Perceptual hash index is loaded at worker startup and synced with db by background task,
+so similar images search never loads rows on request path
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import AsyncIterator, Optional
+
+from app.core.config import settings
+from app.core.phash_index import phash_index
+from app.crud import ImageCRUD
+from app.db.session import async_session
+
+
+async def get_phash_watermark() -> Optional[datetime]:
+    async with async_session() as session:
+        return await ImageCRUD(session).get_max_updated_at()
+
+
+async def load_phash_batches() -> AsyncIterator[list]:
+    # every batch uses its own session, so neither rows nor transaction are held for the whole load
+    cursor = None
+    while True:
+        async with async_session() as session:
+            rows = await ImageCRUD(session).get_phash_batch(cursor=cursor, limit=settings.PHASH_INDEX_BATCH_SIZE)
+        if not rows:
+            return
+        yield [(item_id, phash, updated_at) for item_id, phash, updated_at, _ in rows]
+        item_id, _, _, created_at = rows[-1]
+        cursor = (created_at, item_id)
+
+
+async def load_phash_updates(updated_after: datetime) -> list:
+    async with async_session() as session:
+        return await ImageCRUD(session).get_phash_updates(updated_after)
+
+
+async def get_existing_ids(item_ids: list) -> set:
+    async with async_session() as session:
+        return await ImageCRUD(session).get_existing_ids(item_ids)
+
+
+class PerceptualHashIndexService:
+    def __init__(self):
+        self._tasks: list[asyncio.Task] = []
+
+    async def sync(self) -> None:
+        try:
+            if not phash_index.loaded:
+                await phash_index.load(await get_phash_watermark(), load_phash_batches())
+            else:
+                await phash_index.sync(load_phash_updates, get_existing_ids, settings.PHASH_INDEX_BATCH_SIZE)
+        except Exception:
+            logging.exception('Perceptual hash index sync failed')
+
+    async def _run_sync(self) -> None:
+        while True:
+            await asyncio.sleep(settings.PHASH_INDEX_SYNC_INTERVAL)
+            await self.sync()
+
+    async def start(self) -> None:
+        # the whole index is loaded before worker accepts requests, then only updated rows are loaded,
+        # failed load is retried by the background task
+        await self.sync()
+        self._tasks = [asyncio.create_task(self._run_sync())]
+
+    def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+
+phash_index_service = PerceptualHashIndexService()
@@ -0,0 +1,379 @@
+"""
+Thumbnails are a disk cache of resized originals limited by THUMBNAILS_CACHE_MAX_BYTES.
+
+Generation is single-flight: concurrent requests of the same thumbnail wait for one resize job.
+In-process requests share a future, requests from other workers wait for the thumbnail advisory lock.
+Evictor takes the same lock, so thumbnails that are generating now are never evicted
+"""
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime
+from typing import Optional
+
+from app.core import image_resizer, metrics, util
+from app.core.config import settings
+from app.core.executor import cpu_executor
+from app.crud import ThumbnailCRUD
+from app.db.session import async_engine, async_session
+from app.models import Image, Thumbnail
+
+EVICTION_LOCK_KEY = 'thumbnails:eviction'
+# every evicted thumbnail lock is held till its batch files are removed
+EVICTION_BATCH_SIZE = 100
+GENERATION_LOCKS_PER_CHUNK = 256
+
+
+def get_thumbnail_key(image_id: uuid.UUID, width: int, height: int, file_type: str, quality: int = 0) -> str:
+    quality_suffix = f':q{quality}' if quality else ''
+    return f'thumbnail:{image_id}:{width}x{height}:{file_type}{quality_suffix}'
+
+
+def get_temp_path(path: str, file_type: str) -> str:
+    # temp file is placed in the same dir to be moved with atomic rename, extension defines saving format
+    return os.path.join(os.path.dirname(path), f'.tmp-{uuid.uuid4()}.{file_type}')
+
+
+class ThumbnailService:
+    def __init__(self):
+        self._in_flight: dict[str, asyncio.Future] = {}
+        self._hits: dict[uuid.UUID, tuple[int, datetime]] = {}
+        self._tasks: list[asyncio.Task] = []
+        self._cache_hits = metrics.counter('thumbnails.cache_hits')
+        self._cache_misses = metrics.counter('thumbnails.cache_misses')
+        self._coalesced = metrics.counter('thumbnails.coalesced')
+        self._thumbnail_sources = metrics.counter('thumbnails.resized_from_thumbnail')
+        self._evictions = metrics.counter('thumbnails.evictions')
+        self._evicted_bytes = metrics.counter('thumbnails.evicted_bytes')
+
+    def track_access(self, thumbnail: Thumbnail) -> None:
+        """
+        Accumulate access in memory, it is written to db by flush_access
+        """
+        self._cache_hits.inc()
+        amount, _ = self._hits.get(thumbnail.id, (0, None))
+        self._hits[thumbnail.id] = (amount + 1, datetime.now())
+
+    async def flush_access(self) -> None:
+        hits, self._hits = self._hits, {}
+        if not hits:
+            return
+        async with async_session() as session:
+            async with session.begin():
+                await ThumbnailCRUD(session).add_hits(hits)
+
+    async def _get_source_path(self, thumbnail_crud: ThumbnailCRUD, image: Image, width: int, height: int) -> str:
+        """
+        Resize from the smallest cached thumbnail that is still not smaller than target like mipmaps,
+        original is used only if there is no such thumbnail.
+        Source lock keeps it from eviction, locks are taken from smaller to larger sizes, so they can not deadlock
+        """
+        source = await thumbnail_crud.get_smallest_covering(image.id, width, height, image.file_type)
+        if source is None:
+            return util.get_image_path(image)
+        key = get_thumbnail_key(source.image_id, source.width, source.height, source.file_type)
+        if await thumbnail_crud.try_advisory_xact_lock(key) and os.path.exists(path := util.get_thumbnail_path(source)):
+            self._thumbnail_sources.inc()
+            return path
+        return util.get_image_path(image)
+
+    async def _generate(self, image: Image, width: int, height: int, file_type: str, quality: int = 0) -> Thumbnail:
+        async with async_session() as session:
+            async with session.begin():
+                thumbnail_crud = ThumbnailCRUD(session)
+                await thumbnail_crud.advisory_xact_lock(get_thumbnail_key(image.id, width, height, file_type, quality))
+                thumbnail: Optional[Thumbnail] = await thumbnail_crud.get_by_size(
+                    image.id, width, height, file_type, quality
+                )
+                if thumbnail is not None and os.path.exists(util.get_thumbnail_path(thumbnail)):
+                    self.track_access(thumbnail)
+                    return thumbnail
+                self._cache_misses.inc()
+                if thumbnail is None:
+                    thumbnail = await thumbnail_crud.create(
+                        image=image, width=width, height=height, file_type=file_type, quality=quality
+                    )
+                path = util.get_thumbnail_path(thumbnail)
+                temp_path = get_temp_path(path, file_type)
+                source_path = await self._get_source_path(thumbnail_crud, image, width, height)
+                try:
+                    await cpu_executor.run(
+                        image_resizer.resize_image, source_path, temp_path, (width, height), quality=quality
+                    )
+                    thumbnail = await thumbnail_crud.update_size(thumbnail.id, os.path.getsize(temp_path))
+                    os.replace(temp_path, path)
+                finally:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+                return thumbnail
+
+    async def get_cached(
+            self,
+            image: Image,
+            width: int,
+            height: int,
+            file_type: str,
+            thumbnail_crud: ThumbnailCRUD,
+            quality: int = 0,
+    ) -> Optional[Thumbnail]:
+        """
+        Get thumbnail with existing file without taking a lock, None on cache miss
+        """
+        thumbnail = await thumbnail_crud.get_by_size(image.id, width, height, file_type, quality)
+        if thumbnail is not None and os.path.exists(util.get_thumbnail_path(thumbnail)):
+            self.track_access(thumbnail)
+            return thumbnail
+        return None
+
+    async def get_or_create(
+            self,
+            image: Image,
+            width: int,
+            height: int,
+            file_type: str,
+            thumbnail_crud: ThumbnailCRUD = None,
+            quality: int = 0,
+    ) -> Thumbnail:
+        """
+        Get thumbnail with existing file or generate it, waiting for the same in-flight generation if there is.
+        Thumbnails of other file type or quality than original are its transcoded renditions.
+        Passed crud is used for the cache hit check without taking a lock
+        """
+        if thumbnail_crud is not None and (
+                thumbnail := await self.get_cached(image, width, height, file_type, thumbnail_crud, quality)
+        ):
+            return thumbnail
+        key = get_thumbnail_key(image.id, width, height, file_type, quality)
+        if (future := self._in_flight.get(key)) is not None:
+            self._coalesced.inc()
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            thumbnail = await self._generate(image, width, height, file_type, quality)
+            future.set_result(thumbnail)
+            return thumbnail
+        except asyncio.CancelledError as e:
+            future.cancel()
+            raise e
+        except Exception as e:
+            future.set_exception(e)
+            # mark exception as retrieved, when there are no waiters
+            future.exception()
+            raise e
+        finally:
+            del self._in_flight[key]
+
+    async def _render_many(self, image: Image, sizes: list[tuple[int, int]]) -> list[dict]:
+        """
+        Decode original once, write thumbnail files of all sizes and return values of their rows
+        """
+        paths = [util.get_thumbnail_path_by(image.id, w, h, image.file_type) for w, h in sizes]
+        temp_paths = [get_temp_path(path, image.file_type) for path in paths]
+        values = []
+        try:
+            await cpu_executor.run(
+                image_resizer.resize_many, util.get_image_path(image), list(zip(temp_paths, sizes))
+            )
+            for (width, height), path, temp_path in zip(sizes, paths, temp_paths):
+                values.append(dict(
+                    image_id=image.id,
+                    width=width,
+                    height=height,
+                    file_type=image.file_type,
+                    size=os.path.getsize(temp_path),
+                ))
+                os.replace(temp_path, path)
+        finally:
+            for temp_path in temp_paths:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        return values
+
+    async def _generate_chunk(self, items: list[tuple[Image, list[tuple[int, int]]]]) -> list[Thumbnail]:
+        """
+        Generate thumbnails of images chunk in own transaction under their advisory locks like _generate does.
+        Thumbnails that were generated by others while locks were awaited are not rendered again
+        """
+        async with async_session() as session:
+            async with session.begin():
+                thumbnail_crud = ThumbnailCRUD(session)
+                await thumbnail_crud.advisory_xact_locks([
+                    get_thumbnail_key(image.id, width, height, image.file_type)
+                    for image, sizes in items for width, height in sizes
+                ])
+                rows = {
+                    (it.image_id, it.width, it.height, it.file_type): it
+                    for it in await thumbnail_crud.get_all(image_id=[image.id for image, _ in items], quality=0)
+                }
+                thumbnails = []
+                missing = []
+                for image, sizes in items:
+                    missing_sizes = []
+                    for width, height in sizes:
+                        row = rows.get((image.id, width, height, image.file_type))
+                        if row is not None and os.path.exists(util.get_thumbnail_path(row)):
+                            thumbnails.append(row)
+                        else:
+                            missing_sizes.append((width, height))
+                    if missing_sizes:
+                        missing.append((image, missing_sizes))
+                values = [
+                    item for rendered in await asyncio.gather(*(
+                        self._render_many(image, sizes) for image, sizes in missing
+                    )) for item in rendered
+                ]
+                # row of thumbnail that lost its file is kept, only its file and size are written again
+                lost = {}
+                for item in values:
+                    if (row := rows.get((item['image_id'], item['width'], item['height'], item['file_type']))):
+                        row.size = item['size']
+                        lost[row.id] = row
+                await thumbnail_crud.update_sizes({row_id: row.size for row_id, row in lost.items()})
+                thumbnails.extend(lost.values())
+                thumbnails.extend(await thumbnail_crud.create_many([
+                    item for item in values
+                    if (item['image_id'], item['width'], item['height'], item['file_type']) not in rows
+                ]))
+                return thumbnails
+
+    async def generate_many(
+            self,
+            items: list[tuple[Image, list[tuple[int, int]]]],
+            thumbnail_crud: ThumbnailCRUD,
+    ) -> list[Thumbnail]:
+        """
+        Generate thumbnails of all sizes for every image. Each image is decoded once and images are resized
+        in parallel. Existing thumbnails are found with passed crud without locks, missing ones are generated
+        by chunks, each in own transaction under thumbnails locks with a single insert of new rows
+        """
+        rows = {
+            (it.image_id, it.width, it.height, it.file_type): it
+            for it in await thumbnail_crud.get_all(image_id=list({image.id for image, _ in items}), quality=0)
+        }
+        existing = {key: it for key, it in rows.items() if os.path.exists(util.get_thumbnail_path(it))}
+        thumbnails = {}
+        missing = []
+        for image, sizes in items:
+            missing_sizes = []
+            for width, height in dict.fromkeys(sizes):
+                key = (image.id, width, height, image.file_type)
+                if key in existing:
+                    self.track_access(existing[key])
+                    thumbnails[key] = existing[key]
+                else:
+                    self._cache_misses.inc()
+                    missing_sizes.append((width, height))
+            if missing_sizes:
+                missing.append((image, missing_sizes))
+        # chunks are bounded by executor capacity and amount of locks held by one transaction
+        chunks = [[]]
+        for image, sizes in missing:
+            chunk_sizes = sum(len(it) for _, it in chunks[-1])
+            if len(chunks[-1]) >= cpu_executor.capacity or chunk_sizes + len(sizes) > GENERATION_LOCKS_PER_CHUNK:
+                chunks.append([])
+            chunks[-1].append((image, sizes))
+        for chunk in chunks:
+            if chunk:
+                for thumbnail in await self._generate_chunk(chunk):
+                    thumbnails[(thumbnail.image_id, thumbnail.width, thumbnail.height, thumbnail.file_type)] = thumbnail
+        return list(thumbnails.values())
+
+    async def generate_presets(self, image: Image) -> list[Thumbnail]:
+        """
+        Decode original once and generate all THUMBNAIL_PRESETS widths that are smaller than original
+        """
+        if not settings.THUMBNAIL_PRESETS:
+            return []
+        input_path = util.get_image_path(image)
+        original_size = image.dimensions or image_resizer.get_size(input_path)
+        original_width, _ = original_size
+        sizes = [
+            image_resizer.get_new_size(input_path, width, None, original_size=original_size)
+            for width in settings.THUMBNAIL_PRESETS if width < original_width
+        ]
+        if not sizes:
+            return []
+        async with async_session() as session:
+            async with session.begin():
+                return await self.generate_many([(image, sizes)], ThumbnailCRUD(session))
+
+    async def evict(self, max_bytes: int = None, policy: str = None) -> int:
+        """
+        Remove the least valuable thumbnails (rows and files) while cache size is over budget.
+        Every batch is committed separately and its files are removed after commit, thumbnails locks are held
+        on session level till files are removed, so regeneration of evicted thumbnails waits for it.
+        Returns amount of freed bytes
+        """
+        max_bytes = settings.THUMBNAILS_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        policy = policy or settings.THUMBNAILS_CACHE_POLICY
+        # session level locks are bound to connection, so all batches are run on the same one
+        async with async_engine.connect() as connection, async_session(bind=connection) as session:
+            thumbnail_crud = ThumbnailCRUD(session)
+            try:
+                async with session.begin():
+                    # only one worker evicts at the time
+                    if not await thumbnail_crud.try_advisory_locks([EVICTION_LOCK_KEY]):
+                        return 0
+                    excess = await thumbnail_crud.get_total_size() - max_bytes
+                freed = 0
+                skipped = 0
+                while freed < excess:
+                    async with session.begin():
+                        candidates = await thumbnail_crud.get_eviction_candidates(
+                            policy, offset=skipped, limit=EVICTION_BATCH_SIZE
+                        )
+                        if not candidates:
+                            break
+                        chosen = {}
+                        planned = freed
+                        for thumbnail in candidates:
+                            if planned >= excess:
+                                break
+                            chosen[get_thumbnail_key(thumbnail.image_id, thumbnail.width, thumbnail.height,
+                                                     thumbnail.file_type, thumbnail.quality)] = thumbnail
+                            planned += thumbnail.size or 0
+                        # thumbnails that are generating now are skipped
+                        locked = await thumbnail_crud.try_advisory_locks(list(chosen))
+                        skipped += len(chosen) - len(locked)
+                        evicted = []
+                        if locked:
+                            evicted = await thumbnail_crud.delete_by(id=[chosen[key].id for key in locked])
+                    for thumbnail in evicted:
+                        await thumbnail_crud.delete_content(thumbnail)
+                    async with session.begin():
+                        await thumbnail_crud.advisory_unlock(locked)
+                    self._evictions.inc(len(evicted))
+                    freed += sum(it.size or 0 for it in evicted)
+                self._evicted_bytes.inc(freed)
+                return freed
+            finally:
+                async with session.begin():
+                    await thumbnail_crud.advisory_unlock_all()
+
+    async def _run_periodically(self, func, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await func()
+            except Exception:
+                logging.exception(f'Thumbnails {func.__name__} failed')
+
+    def start(self) -> None:
+        self._tasks = [
+            asyncio.create_task(self._run_periodically(self.flush_access, settings.THUMBNAILS_ACCESS_FLUSH_INTERVAL)),
+        ]
+        if settings.THUMBNAILS_CACHE_MAX_BYTES:
+            self._tasks.append(asyncio.create_task(
+                self._run_periodically(self.evict, settings.THUMBNAILS_CACHE_EVICTION_INTERVAL)
+            ))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        await self.flush_access()
+
+
+thumbnail_service = ThumbnailService()
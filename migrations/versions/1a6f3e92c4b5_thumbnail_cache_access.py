@@ -0,0 +1,71 @@
+"""thumbnail cache access
+
+Revision ID: 1a6f3e92c4b5
+Revises: f0c28d5e7a13
+Create Date: 2026-10-18 16:18:09.553720
+
+"""
+import os
+
+from alembic import op
+import sqlalchemy as sa
+
+from app.core.config import settings
+
+# revision identifiers, used by Alembic.
+revision = '1a6f3e92c4b5'
+down_revision = 'f0c28d5e7a13'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+
+def backfill_size() -> None:
+    """
+    Thumbnails were created without size, cache budget counts rows by it. Rows without files take no space
+    """
+    connection = op.get_bind()
+    thumbnail = sa.table(
+        'thumbnail',
+        sa.column('id'),
+        sa.column('image_id'),
+        sa.column('width'),
+        sa.column('height'),
+        sa.column('file_type'),
+        sa.column('size'),
+    )
+    rows = connection.execution_options(stream_results=True).execute(
+        sa.select(thumbnail.c.id, thumbnail.c.image_id, thumbnail.c.width, thumbnail.c.height, thumbnail.c.file_type)
+        .where(thumbnail.c.size.is_(None))
+    )
+    update = (
+        sa.update(thumbnail)
+        .where(thumbnail.c.id == sa.bindparam('thumbnail_id'))
+        .values(size=sa.bindparam('file_size'))
+    )
+    batch = []
+    for thumbnail_id, image_id, width, height, file_type in rows:
+        path = os.path.join(settings.STORAGE_DIR, f'{image_id}_{width}x{height}.{file_type}')
+        batch.append({'thumbnail_id': thumbnail_id, 'file_size': os.path.getsize(path) if os.path.exists(path) else 0})
+        if len(batch) >= BATCH_SIZE:
+            connection.execute(update, batch)
+            batch = []
+    if batch:
+        connection.execute(update, batch)
+
+
+def upgrade() -> None:
+    op.add_column('thumbnail', sa.Column('hits', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('thumbnail', sa.Column('last_accessed_at', sa.DateTime(), nullable=True))
+    op.execute('UPDATE thumbnail SET last_accessed_at = created_at')
+    backfill_size()
+    op.create_index(op.f('ix_thumbnail_last_accessed_at'), 'thumbnail', ['last_accessed_at'], unique=False)
+    op.create_index('ix_thumbnail_hits_last_accessed_at', 'thumbnail', ['hits', 'last_accessed_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_thumbnail_hits_last_accessed_at', table_name='thumbnail')
+    op.drop_index(op.f('ix_thumbnail_last_accessed_at'), table_name='thumbnail')
+    op.drop_column('thumbnail', 'last_accessed_at')
+    op.drop_column('thumbnail', 'hits')
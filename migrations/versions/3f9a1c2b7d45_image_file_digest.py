@@ -0,0 +1,63 @@
+"""image file digest
+
+Revision ID: 3f9a1c2b7d45
+Revises: 6c5f431ed45d
+Create Date: 2026-10-18 10:12:31.482107
+
+"""
+import hashlib
+import os
+
+from alembic import op
+import sqlalchemy as sa
+
+from app.core.config import settings
+
+# revision identifiers, used by Alembic.
+revision = '3f9a1c2b7d45'
+down_revision = '6c5f431ed45d'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+
+def get_file_digest(path):
+    digest = hashlib.blake2b(digest_size=32)
+    with open(path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def backfill_file_digest() -> None:
+    connection = op.get_bind()
+    image = sa.table('image', sa.column('id'), sa.column('file_type'), sa.column('file_digest'))
+    rows = connection.execution_options(stream_results=True).execute(sa.select(image.c.id, image.c.file_type))
+    update = (
+        sa.update(image)
+        .where(image.c.id == sa.bindparam('image_id'))
+        .values(file_digest=sa.bindparam('digest'))
+    )
+    batch = []
+    for image_id, file_type in rows:
+        path = os.path.join(settings.STORAGE_DIR, f'{image_id}.{file_type}')
+        if not os.path.exists(path):
+            continue
+        batch.append({'image_id': image_id, 'digest': get_file_digest(path)})
+        if len(batch) >= BATCH_SIZE:
+            connection.execute(update, batch)
+            batch = []
+    if batch:
+        connection.execute(update, batch)
+
+
+def upgrade() -> None:
+    op.add_column('image', sa.Column('file_digest', sa.String(length=128), nullable=True))
+    op.create_index(op.f('ix_image_file_digest'), 'image', ['file_digest'], unique=False)
+    backfill_file_digest()
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_image_file_digest'), table_name='image')
+    op.drop_column('image', 'file_digest')
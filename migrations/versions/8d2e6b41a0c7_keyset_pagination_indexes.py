@@ -0,0 +1,27 @@
+"""keyset pagination indexes
+
+Revision ID: 8d2e6b41a0c7
+Revises: 3f9a1c2b7d45
+Create Date: 2026-10-18 11:40:05.917264
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8d2e6b41a0c7'
+down_revision = '3f9a1c2b7d45'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_image_created_at_id', 'image', ['created_at', 'id'], unique=False)
+    op.create_index(
+        'ix_thumbnail_image_id_created_at_id', 'thumbnail', ['image_id', 'created_at', 'id'], unique=False
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_thumbnail_image_id_created_at_id', table_name='thumbnail')
+    op.drop_index('ix_image_created_at_id', table_name='image')
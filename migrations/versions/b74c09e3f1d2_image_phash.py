@@ -0,0 +1,29 @@
+"""image perceptual hash
+
+Revision ID: b74c09e3f1d2
+Revises: 8d2e6b41a0c7
+Create Date: 2026-10-18 13:05:48.226310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b74c09e3f1d2'
+down_revision = '8d2e6b41a0c7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # existing images are filled by `python -m app.jobs.phash_backfill`
+    op.add_column('image', sa.Column('phash', sa.BigInteger(), nullable=True))
+    op.create_index(op.f('ix_image_phash'), 'image', ['phash'], unique=False)
+    op.create_index('ix_image_updated_at', 'image', ['updated_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_image_updated_at', table_name='image')
+    op.drop_index(op.f('ix_image_phash'), table_name='image')
+    op.drop_column('image', 'phash')
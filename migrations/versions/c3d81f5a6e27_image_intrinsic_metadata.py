@@ -0,0 +1,35 @@
+"""image intrinsic metadata
+
+Revision ID: c3d81f5a6e27
+Revises: 1a6f3e92c4b5
+Create Date: 2026-10-18 17:42:31.184027
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3d81f5a6e27'
+down_revision = '1a6f3e92c4b5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # existing images are filled by `python -m app.jobs.image_info_backfill`
+    op.add_column('image', sa.Column('width', sa.Integer(), nullable=True))
+    op.add_column('image', sa.Column('height', sa.Integer(), nullable=True))
+    op.add_column('image', sa.Column('mode', sa.String(length=16), nullable=True))
+    op.add_column('image', sa.Column('channels', sa.Integer(), nullable=True))
+    op.add_column('image', sa.Column('frames', sa.Integer(), nullable=True))
+    op.add_column('image', sa.Column('decoded_size', sa.BigInteger(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('image', 'decoded_size')
+    op.drop_column('image', 'frames')
+    op.drop_column('image', 'channels')
+    op.drop_column('image', 'mode')
+    op.drop_column('image', 'height')
+    op.drop_column('image', 'width')
@@ -0,0 +1,34 @@
+"""thumbnail rendition quality
+
+Revision ID: d96a2b7c41e8
+Revises: c3d81f5a6e27
+Create Date: 2026-10-18 20:11:47.602915
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd96a2b7c41e8'
+down_revision = 'c3d81f5a6e27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('thumbnail', sa.Column('quality', sa.Integer(), server_default='0', nullable=False))
+    op.drop_index('ix_thumbnail_image_id_size', table_name='thumbnail')
+    op.create_index(
+        'ix_thumbnail_image_id_size', 'thumbnail', ['image_id', 'width', 'height', 'file_type', 'quality'], unique=True
+    )
+
+
+def downgrade() -> None:
+    # renditions of not default quality can not be kept with the narrower unique index
+    op.execute('DELETE FROM thumbnail WHERE quality != 0')
+    op.drop_index('ix_thumbnail_image_id_size', table_name='thumbnail')
+    op.create_index(
+        'ix_thumbnail_image_id_size', 'thumbnail', ['image_id', 'width', 'height', 'file_type'], unique=True
+    )
+    op.drop_column('thumbnail', 'quality')
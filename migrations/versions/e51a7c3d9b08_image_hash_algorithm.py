@@ -0,0 +1,27 @@
+"""image hash algorithm
+
+Revision ID: e51a7c3d9b08
+Revises: b74c09e3f1d2
+Create Date: 2026-10-18 14:21:17.640913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e51a7c3d9b08'
+down_revision = 'b74c09e3f1d2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # all existing hashes are md5 of decoded pixels
+    op.add_column('image', sa.Column('hash_algorithm', sa.String(length=32), server_default='md5', nullable=False))
+    op.add_column('image', sa.Column('hash_version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('image', 'hash_version')
+    op.drop_column('image', 'hash_algorithm')
@@ -0,0 +1,35 @@
+"""thumbnail unique size
+
+Revision ID: f0c28d5e7a13
+Revises: e51a7c3d9b08
+Create Date: 2026-10-18 15:02:44.108356
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'f0c28d5e7a13'
+down_revision = 'e51a7c3d9b08'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # concurrent generation could create duplicated rows for the same file, only the oldest one is kept
+    op.execute("""
+        DELETE FROM thumbnail t
+        USING thumbnail d
+        WHERE t.image_id = d.image_id
+            AND t.width = d.width
+            AND t.height = d.height
+            AND t.file_type = d.file_type
+            AND (t.created_at, t.id) > (d.created_at, d.id)
+    """)
+    op.create_index(
+        'ix_thumbnail_image_id_size', 'thumbnail', ['image_id', 'width', 'height', 'file_type'], unique=True
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_thumbnail_image_id_size', table_name='thumbnail')
@@ -0,0 +1,111 @@
+"""
+Stub front proxy for local check of FILE_DELIVERY modes without nginx
+
+Usage: python -m scripts.delivery_proxy_stub --upstream localhost:8000 \
+    --location /protected/storage/=.storage --location /protected/diffs/=.diffs [--check /api/images/{id}/file]
+It forwards GET requests to app and sends files of X-Accel-Redirect (by locations) and X-Sendfile (by path) headers
+like front proxy does. With --check it requests url directly and through the stub and compares responses
+"""
+import argparse
+import http.client
+import os
+import shutil
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import unquote
+
+REDIRECT_HEADERS = ('x-accel-redirect', 'x-sendfile')
+# headers of file body that are set by proxy
+FILE_HEADERS = ('content-length', 'transfer-encoding', 'connection')
+
+
+def get_file_path(headers: http.client.HTTPMessage, locations: dict[str, str]) -> Optional[str]:
+    if path := headers.get('x-sendfile'):
+        return path
+    if uri := headers.get('x-accel-redirect'):
+        for location, directory in locations.items():
+            if uri.startswith(location):
+                return os.path.join(directory, unquote(uri[len(location):]))
+        raise ValueError(f'no location for {uri}')
+    return None
+
+
+def create_handler(upstream: str, locations: dict[str, str]) -> type[BaseHTTPRequestHandler]:
+    class ProxyHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            connection = http.client.HTTPConnection(upstream)
+            connection.request('GET', self.path, headers={
+                k: v for k, v in self.headers.items() if k.lower() not in ('host', 'connection')
+            })
+            response = connection.getresponse()
+            body = response.read()
+            connection.close()
+            path = get_file_path(response.headers, locations)
+            if path is None or response.status != 200:
+                self.send_response(response.status)
+                for k, v in response.headers.items():
+                    if k.lower() not in ('transfer-encoding', 'connection'):
+                        self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            if not os.path.isfile(path):
+                self.send_error(404, f'internal redirect to missing file {path}')
+                return
+            self.send_response(200)
+            for k, v in response.headers.items():
+                if k.lower() not in (*REDIRECT_HEADERS, *FILE_HEADERS):
+                    self.send_header(k, v)
+            self.send_header('Content-Length', str(os.path.getsize(path)))
+            self.send_header('X-Delivered-By', 'proxy-stub')
+            self.end_headers()
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, self.wfile)
+
+    return ProxyHandler
+
+
+def get(host: str, url: str) -> tuple[int, http.client.HTTPMessage, bytes]:
+    connection = http.client.HTTPConnection(host)
+    connection.request('GET', url)
+    response = connection.getresponse()
+    result = response.status, response.headers, response.read()
+    connection.close()
+    return result
+
+
+def check(upstream: str, proxy: str, url: str) -> None:
+    status, headers, body = get(upstream, url)
+    redirect = {k: headers[k] for k in REDIRECT_HEADERS if k in headers}
+    print(f'app:   {status} {redirect or "no internal redirect"}, body {len(body)} bytes')
+    proxy_status, proxy_headers, proxy_body = get(proxy, url)
+    print(f'proxy: {proxy_status} {proxy_headers.get("content-type")}, body {len(proxy_body)} bytes, '
+          f'delivered by {proxy_headers.get("x-delivered-by", "app")}')
+    assert status == proxy_status, 'statuses of app and proxy are different'
+    if redirect:
+        assert not body, 'app response with internal redirect has body'
+        assert proxy_headers.get('x-delivered-by') == 'proxy-stub', 'file is not sent by proxy'
+        assert proxy_headers.get('etag') == headers.get('etag'), 'app validators are lost'
+    print('ok')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stub front proxy for X-Accel-Redirect and X-Sendfile delivery')
+    parser.add_argument('--upstream', default='localhost:8000', help='App host:port')
+    parser.add_argument('--port', type=int, default=8081, help='Stub proxy port')
+    parser.add_argument('--location', action='append', default=[], metavar='URI=DIR',
+                        help='Internal location and its dir like nginx alias')
+    parser.add_argument('--check', metavar='URL', help='Compare response of url from app and stub proxy and exit')
+    args = parser.parse_args()
+    locations = dict(it.split('=', 1) for it in args.location)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), create_handler(args.upstream, locations))
+    if args.check:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            check(args.upstream, f'127.0.0.1:{args.port}', args.check)
+        finally:
+            server.shutdown()
+    else:
+        print(f'Proxy of {args.upstream} on 127.0.0.1:{args.port}')
+        server.serve_forever()
@@ -0,0 +1,42 @@
+"""
+Benchmark of vectorized pixels diff from app.core.image_comparator
+
+Usage: python -m scripts.diff_benchmark [--image path/to/image] [--amount 20]
+Without image it compares random 4K RGB frame with its copy changed in a few regions
+"""
+import argparse
+import time
+
+import numpy as np
+
+from app.core import image_comparator
+
+FRAME_4K_SHAPE = (2160, 3840, 3)
+
+
+def get_frames(image_path=None):
+    if image_path:
+        frame, _ = image_comparator.load_pixels(image_path, image_path)
+    else:
+        frame = np.random.default_rng(0).integers(0, 256, FRAME_4K_SHAPE, dtype=np.uint8)
+    changed = frame.copy()
+    changed[100:200, 300:500] //= 2
+    changed[-1, -1] = 255 - changed[-1, -1]
+    return frame, changed
+
+
+def benchmark(frames, amount):
+    for name, tolerance in (('exact', 0), ('tolerance', 8), ('per-channel', (8, 4, 16))):
+        start_time = time.perf_counter()
+        for _ in range(amount):
+            stats = image_comparator.diff(*frames, tolerance).stats
+        elapsed = (time.perf_counter() - start_time) / amount
+        print(f'{name:12s} {elapsed * 1000:8.2f} ms  changed {stats.changed_pixels} bbox {stats.bbox}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Vectorized pixels diff benchmark')
+    parser.add_argument('--image', help='Image to decode and compare with its changed copy')
+    parser.add_argument('--amount', type=int, default=20, help='Amount of diff runs for each tolerance')
+    args = parser.parse_args()
+    benchmark(get_frames(args.image), args.amount)
@@ -0,0 +1,101 @@
+"""
+Benchmark of large file downloads from one uvicorn worker with app.core.file_response.RangeFileResponse
+
+Usage: python -m scripts.file_download_benchmark [--size 300] [--amount 3] [--chunk-sizes 65536 262144 1048576]
+Server runs in a separate process, so client reading does not share GIL with it
+"""
+import argparse
+import http.client
+import multiprocessing
+import os
+import tempfile
+import time
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import FileResponse
+from starlette.routing import Route
+
+from app.core.file_response import RangeFileResponse
+
+HOST = '127.0.0.1'
+PORT = 8765
+READ_SIZE = 1024 * 1024
+
+
+def create_app(path: str) -> Starlette:
+    def get_starlette_file(request):
+        return FileResponse(path, media_type='image/png')
+
+    def get_range_file(request):
+        return RangeFileResponse(path, media_type='image/png', chunk_size=int(request.query_params['chunk_size']))
+
+    return Starlette(routes=[Route('/starlette', get_starlette_file), Route('/range', get_range_file)])
+
+
+def run_server(path: str) -> None:
+    uvicorn.run(create_app(path), host=HOST, port=PORT, log_level='warning')
+
+
+def download(url: str, headers: dict = None) -> tuple[int, float]:
+    buffer = bytearray(READ_SIZE)
+    connection = http.client.HTTPConnection(HOST, PORT)
+    start_time = time.perf_counter()
+    connection.request('GET', url, headers=headers or {})
+    response = connection.getresponse()
+    size = 0
+    while read := response.readinto(buffer):
+        size += read
+    elapsed = time.perf_counter() - start_time
+    connection.close()
+    return size, elapsed
+
+
+def wait_for_server(timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            http.client.HTTPConnection(HOST, PORT).connect()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def benchmark(size: int, amount: int, chunk_sizes: list[int]) -> None:
+    ranges = ', '.join(f'{it}-{it + size // 16}' for it in range(0, size, size // 4))
+    cases = [('starlette FileResponse (64 KiB)', '/starlette', None)]
+    for chunk_size in chunk_sizes:
+        cases.extend([
+            (f'full file, chunk {chunk_size // 1024} KiB', f'/range?chunk_size={chunk_size}', None),
+            (f'single range 1/2, chunk {chunk_size // 1024} KiB', f'/range?chunk_size={chunk_size}',
+             {'Range': f'bytes={size // 4}-{size // 4 * 3 - 1}'}),
+            (f'4 ranges 1/16, chunk {chunk_size // 1024} KiB', f'/range?chunk_size={chunk_size}',
+             {'Range': f'bytes={ranges}'}),
+        ])
+    for name, url, headers in cases:
+        results = [download(url, headers) for _ in range(amount)]
+        downloaded = results[0][0]
+        elapsed = min(it[1] for it in results)
+        print(f'{name:42s} {downloaded / 1024 ** 2:8.1f} MiB {elapsed * 1000:9.1f} ms '
+              f'{downloaded / 1024 ** 2 / elapsed:8.1f} MiB/s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Large file downloads benchmark')
+    parser.add_argument('--size', type=int, default=300, help='Size of downloaded file in MiB')
+    parser.add_argument('--amount', type=int, default=3, help='Amount of downloads of each case, the best is shown')
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[64 * 1024, 256 * 1024, 1024 * 1024])
+    args = parser.parse_args()
+    with tempfile.NamedTemporaryFile(suffix='.png') as f:
+        for _ in range(args.size):
+            f.write(os.urandom(1024 * 1024))
+        f.flush()
+        server = multiprocessing.Process(target=run_server, args=(f.name,), daemon=True)
+        server.start()
+        try:
+            wait_for_server()
+            benchmark(args.size * 1024 * 1024, args.amount, args.chunk_sizes)
+        finally:
+            server.terminate()
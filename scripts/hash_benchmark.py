@@ -0,0 +1,39 @@
+"""
+Benchmark of registered pixels hash algorithms
+
+Usage: python -m scripts.hash_benchmark [--image path/to/image] [--amount 20]
+Without image it hashes random buffer with the size of decoded 4K RGB frame
+"""
+import argparse
+import os
+import time
+
+from app.core import hash_algorithms
+
+FRAME_4K_SIZE = 3840 * 2160 * 3
+
+
+def get_buffer(image_path=None):
+    if not image_path:
+        return memoryview(os.urandom(FRAME_4K_SIZE))
+    import cv2
+    import numpy as np
+    return memoryview(np.ascontiguousarray(cv2.imread(image_path, cv2.IMREAD_COLOR))).cast('B')
+
+
+def benchmark(buffer, amount):
+    for name, algorithm in hash_algorithms.ALGORITHMS.items():
+        start_time = time.perf_counter()
+        for _ in range(amount):
+            algorithm.hexdigest(buffer)
+        elapsed = (time.perf_counter() - start_time) / amount
+        throughput = buffer.nbytes / elapsed / 2 ** 20
+        print(f'{name:10s} v{algorithm.version}  {elapsed * 1000:8.2f} ms  {throughput:8.1f} MiB/s')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Registered pixels hash algorithms benchmark')
+    parser.add_argument('--image', help='Image to decode and hash')
+    parser.add_argument('--amount', type=int, default=20, help='Amount of hashing runs for each algorithm')
+    args = parser.parse_args()
+    benchmark(get_buffer(args.image), args.amount)
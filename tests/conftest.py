@@ -0,0 +1,8 @@
+import os
+import tempfile
+
+# settings are read at import of app modules, so tests environment is set before them
+os.environ['ENVIRONMENT'] = 'PYTEST'
+os.environ['AUTORUN_MIGRATIONS'] = 'False'
+os.environ['CPU_EXECUTOR_TYPE'] = 'thread'
+os.environ.setdefault('STORAGE_DIR', tempfile.mkdtemp(prefix='image-storage-'))
@@ -0,0 +1,84 @@
+"""
+Files delivery by the app and offloaded to front proxy, proxy is the stub of scripts.delivery_proxy_stub
+"""
+import os
+import socket
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import pytest
+import uvicorn
+from starlette.applications import Starlette
+from starlette.routing import Route
+
+from app.api.endpoints.images import get_file_response
+from app.core.config import settings
+from scripts.delivery_proxy_stub import create_handler, get
+
+FILE_CONTENT = os.urandom(256 * 1024)
+HEADERS = {'Content-Type': 'image/png', 'ETag': '"file-digest"', 'Cache-Control': 'no-cache'}
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def stored_file():
+    # name needs quoting in internal redirect uri
+    path = os.path.join(settings.STORAGE_DIR, 'delivered file.png')
+    with open(path, 'wb') as f:
+        f.write(FILE_CONTENT)
+    yield path
+    os.remove(path)
+
+
+@pytest.fixture
+def upstream(stored_file):
+    app = Starlette(routes=[Route('/file', lambda request: get_file_response(stored_file, HEADERS))])
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=get_free_port(), log_level='warning'))
+    server.install_signal_handlers = lambda: None
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    yield f'127.0.0.1:{server.config.port}'
+    server.should_exit = True
+    thread.join()
+
+
+@pytest.fixture
+def proxy(upstream):
+    locations = {settings.FILE_DELIVERY_STORAGE_LOCATION: settings.STORAGE_DIR}
+    server = ThreadingHTTPServer(('127.0.0.1', 0), create_handler(upstream, locations))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('mode', ['x-accel-redirect', 'x-sendfile'])
+def test_offloaded_file_is_sent_by_proxy(monkeypatch, upstream, proxy, mode):
+    monkeypatch.setattr(settings, 'FILE_DELIVERY', mode)
+    status, headers, body = get(upstream, '/file')
+    assert status == 200
+    assert headers.get(mode) is not None
+    assert body == b''
+    status, headers, body = get(proxy, '/file')
+    assert status == 200
+    assert headers['x-delivered-by'] == 'proxy-stub'
+    assert headers['etag'] == HEADERS['ETag']
+    assert headers['cache-control'] == HEADERS['Cache-Control']
+    assert body == FILE_CONTENT
+
+
+def test_file_is_sent_by_app(monkeypatch, upstream, proxy):
+    monkeypatch.setattr(settings, 'FILE_DELIVERY', 'app')
+    status, headers, body = get(proxy, '/file')
+    assert status == 200
+    assert 'x-delivered-by' not in headers
+    assert headers['etag'] == HEADERS['ETag']
+    assert body == FILE_CONTENT
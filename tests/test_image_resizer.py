@@ -0,0 +1,46 @@
+"""
+Thumbnails of palette, bilevel and 16-bit images, box filter reduce does not support some of their modes
+"""
+import os
+
+import pytest
+from PIL import Image
+
+from app.core import image_resizer
+
+SIZE = (2000, 1600)
+THUMBNAIL_SIZE = (200, 160)
+
+
+def create_image(path: str, mode: str) -> None:
+    image = Image.linear_gradient('L').resize(SIZE)
+    if mode == 'P':
+        # palette image with transparent color like GIF ones
+        image = image.convert('RGB').quantize(16)
+        image.info['transparency'] = 0
+    else:
+        image = image.convert(mode)
+    image.save(path)
+
+
+@pytest.mark.parametrize('file_type, mode', [('png', 'P'), ('gif', 'P'), ('png', '1'), ('png', 'I;16')])
+def test_resize_image(tmp_path, file_type, mode):
+    input_path = str(tmp_path / f'original.{file_type}')
+    output_path = str(tmp_path / f'thumbnail.{file_type}')
+    create_image(input_path, mode)
+    image_resizer.resize_image(input_path, output_path, THUMBNAIL_SIZE)
+    with Image.open(output_path) as image:
+        assert image.size == THUMBNAIL_SIZE
+
+
+@pytest.mark.parametrize('file_type, mode', [('png', 'P'), ('gif', 'P'), ('png', '1')])
+def test_resize_many(tmp_path, file_type, mode):
+    input_path = str(tmp_path / f'original.{file_type}')
+    create_image(input_path, mode)
+    sizes = [(1000, 800), THUMBNAIL_SIZE, (20, 16)]
+    outputs = [(str(tmp_path / f'thumbnail-{w}x{h}.{file_type}'), (w, h)) for w, h in sizes]
+    image_resizer.resize_many(input_path, outputs)
+    for path, size in outputs:
+        assert os.path.exists(path)
+        with Image.open(path) as image:
+            assert image.size == size
@@ -0,0 +1,158 @@
+"""
+File endpoints return db connection to pool before file body is sent. The app is called as ASGI application
+by a slow client that records checked out pool connections on every body chunk, db is sqlite with the same pool
+"""
+import asyncio
+import os
+import uuid
+
+import numpy as np
+import pytest
+from PIL import Image as PILImage
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm.session import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from app.api import deps
+from app.core import util
+from app.core.config import settings
+from app.db.base_class import Base
+from app.main import app
+from app.models import Image, Thumbnail
+
+THUMBNAIL_FILE_SIZE = 256 * 1024
+CHUNK_SIZE = 16 * 1024
+
+
+@compiles(UUID, 'sqlite')
+def compile_uuid(type_, compiler, **kwargs):
+    return 'CHAR(36)'
+
+
+async def download_slowly(url: str, delay: float = 0.001) -> tuple[int, int, list[int], list[int]]:
+    """
+    Returns status, body size and checked out connections of request start and of every body chunk
+    """
+    path, _, query = url.partition('?')
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': query.encode(),
+        'root_path': '',
+        'headers': [(b'host', b'localhost')],
+        'client': ('127.0.0.1', 0),
+        'server': ('localhost', 80),
+    }
+    status = None
+    size = 0
+    start_checkouts = []
+    body_checkouts = []
+    request_sent = False
+    pool = app.state.test_engine.sync_engine.pool
+
+    async def receive():
+        nonlocal request_sent
+        if request_sent:
+            # client does not disconnect
+            await asyncio.Event().wait()
+        request_sent = True
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        nonlocal status, size
+        if message['type'] == 'http.response.start':
+            status = message['status']
+            start_checkouts.append(pool.checkedout())
+        elif message['type'] == 'http.response.body':
+            size += len(message['body'])
+            body_checkouts.append(pool.checkedout())
+            await asyncio.sleep(delay)
+
+    await app(scope, receive, send)
+    return status, size, start_checkouts, body_checkouts
+
+
+def create_image_file(image: Image, pixels: np.ndarray) -> str:
+    path = util.get_image_path(image)
+    PILImage.fromarray(pixels).save(path)
+    return path
+
+
+@pytest.fixture
+def stored_files(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'FILE_CHUNK_SIZE', CHUNK_SIZE)
+    engine = create_async_engine(f'sqlite+aiosqlite:///{tmp_path / "db.sqlite"}', poolclass=AsyncAdaptedQueuePool)
+    session_factory = sessionmaker(engine, expire_on_commit=False, class_=AsyncSession)
+
+    async def get_db_session() -> AsyncSession:
+        async with session_factory() as session:
+            async with session.begin():
+                yield session
+
+    images = [
+        Image(id=uuid.uuid4(), file_type='png', hash=uuid.uuid4().hex, file_digest=uuid.uuid4().hex, width=256,
+              height=128)
+        for _ in range(2)
+    ]
+    thumbnail = Thumbnail(id=uuid.uuid4(), image_id=images[0].id, file_type='png', width=32, height=16, quality=0)
+
+    async def create_rows():
+        async with engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+        async with session_factory() as session:
+            async with session.begin():
+                session.add_all([*images, thumbnail])
+
+    asyncio.run(create_rows())
+    pixels = np.random.default_rng(0).integers(0, 256, (128, 256, 3), dtype=np.uint8)
+    changed = pixels.copy()
+    changed[:16, :16] //= 2
+    paths = {
+        'image': create_image_file(images[0], pixels),
+        'image2': create_image_file(images[1], changed),
+        'thumbnail': util.get_thumbnail_path(thumbnail),
+    }
+    with open(paths['thumbnail'], 'wb') as f:
+        f.write(os.urandom(THUMBNAIL_FILE_SIZE))
+    app.dependency_overrides[deps.get_db_session] = get_db_session
+    app.state.test_engine = engine
+    yield {'image': images[0].id, 'image2': images[1].id, 'thumbnail': thumbnail.id}, paths
+    del app.dependency_overrides[deps.get_db_session]
+    for path in paths.values():
+        os.remove(path)
+
+
+@pytest.mark.parametrize('url, file', [
+    ('/api/images/{image}/file', 'image'),
+    ('/api/images/{image}/file?w=32', 'thumbnail'),
+    ('/api/images/{image}/file?w=32&h=16', 'thumbnail'),
+    ('/api/images/{image}/thumbnails/{thumbnail}/file', 'thumbnail'),
+    ('/api/images/{image}/compare/{image2}/file', None),
+])
+def test_connection_is_released_before_file_body(stored_files, url, file):
+    ids, paths = stored_files
+
+    async def download():
+        try:
+            return await download_slowly(url.format(**ids))
+        finally:
+            await app.state.test_engine.dispose()
+
+    status, size, start_checkouts, body_checkouts = asyncio.run(download())
+    assert status == 200
+    if file:
+        # file is sent by chunks
+        assert size == os.path.getsize(paths[file])
+        assert len(body_checkouts) >= size // CHUNK_SIZE > 1
+    else:
+        # diff image is computed and sent from memory
+        assert size > 0
+    assert start_checkouts == [0]
+    assert not any(body_checkouts)